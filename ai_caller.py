@@ -1,31 +1,411 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 
 API_KEY = "openrouter_api_key"
 
 url = "https://openrouter.ai/api/v1/chat/completions"
 
+MODEL = "meta-llama/llama-4-maverick:free"  # You can choose any model available on OpenRouter
+
 headers = {
     "Authorization": f"Bearer {API_KEY}",
     "Content-Type": "application/json"
 }
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def sse_delta(line):
+    """Content delta carried by one SSE line: "" when it has none, None at [DONE]."""
+    # SSE comments (": OPENROUTER PROCESSING") and blank keep-alives
+    if not line or not line.startswith("data:"):
+        return ""
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return None
+    try:
+        chunk = json.loads(data)
+    except ValueError:
+        return ""
+    choices = chunk.get("choices") or []
+    if not choices:
+        return ""
+    return (choices[0].get("delta") or {}).get("content") or ""
+
+
+class CircuitBreaker:
+    """Fails fast after `failure_threshold` consecutive upstream failures.
+
+    After `reset_timeout` seconds one trial request is let through (half-open);
+    success closes the circuit again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                # half-open: let one request probe the upstream
+                self.opened_at = self.clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+class AIClient:
+    """Connection-pooled OpenRouter client with timeouts, retries and a circuit breaker."""
+
+    def __init__(self, api_url=url, api_headers=None, model=MODEL,
+                 connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=2, backoff_base=0.5, backoff_max=8.0,
+                 pool_size=10, breaker=None):
+        self.url = api_url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.headers = dict(api_headers if api_headers is not None else headers)
+        self.pool_size = pool_size
+        self.session = self.make_session()
+
+    def make_session(self):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def build_payload(self, sys_prompt, history, message):
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": sys_prompt},
+                {"role": "system", "content": f"This is the previous history for the user that you should keep context of while generating: {history}"},
+                {"role": "user", "content": message},
+            ]
+        }
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def post(self, payload, timeout=None, stream=False):
+        """POST with retries; returns the final response or raises the last network error."""
+        if not self.breaker.allow():
+            raise CircuitOpenError("AI upstream circuit is open")
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.session.post(self.url, json=payload, timeout=timeout or self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                if attempt < self.max_retries:
+                    # release the pooled connection before retrying
+                    response.close()
+            if attempt < self.max_retries:
+                time.sleep(self.backoff(attempt, retry_after))
+        self.breaker.record_failure()
+        if response is not None:
+            return response
+        raise last_error
+
+    def call(self, sys_prompt, history, message, timeout=None):
+        try:
+            response = self.post(self.build_payload(sys_prompt, history, message), timeout=timeout)
+        except CircuitOpenError:
+            return "Error: AI service is temporarily unavailable"
+        except requests.RequestException as e:
+            return f"Error: {e.__class__.__name__} {e}"
+
+        if response.status_code == 200:
+            result = response.json()
+            return result["choices"][0]["message"]["content"]
+        else:
+            return f"Error: {response.status_code} {response.text}"
+
+    def stream(self, sys_prompt, history, message, timeout=None):
+        """Yield content deltas from the provider's SSE token stream.
+
+        Retries only happen before the first byte is received; a failure
+        mid-stream is surfaced as an ``Error: ...`` chunk.
+        """
+        payload = self.build_payload(sys_prompt, history, message)
+        payload["stream"] = True
+        try:
+            response = self.post(payload, timeout=timeout, stream=True)
+        except CircuitOpenError:
+            yield "Error: AI service is temporarily unavailable"
+            return
+        except requests.RequestException as e:
+            yield f"Error: {e.__class__.__name__} {e}"
+            return
+
+        if response.status_code != 200:
+            yield f"Error: {response.status_code} {response.text}"
+            return
+
+        response.encoding = "utf-8"
+        with response:
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    delta = sse_delta(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+            except requests.RequestException as e:
+                yield f"Error: {e.__class__.__name__} {e}"
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncAIClient(AIClient):
+    """asyncio variant of AIClient built on httpx.
+
+    All coroutines run on one background event loop owned by the client, so
+    the concurrency semaphore and the token bucket are global to the process
+    no matter which thread or event loop the caller is on.
+    """
+
+    def __init__(self, max_concurrency=32, rate_per_second=5.0, burst=10, **kwargs):
+        super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def make_session(self):
+        # Requests go through the httpx client created on the event loop
+        return None
+
+    def _ensure_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ai-async-loop", daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+                self.loop = loop
+        return self.loop
+
+    async def _setup(self):
+        connect_timeout, read_timeout = self.timeout
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.bucket = TokenBucket(self.rate_per_second, self.burst)
+        self.http = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+        )
+
+    async def _apost(self, payload, stream=False, timeout=httpx.USE_CLIENT_DEFAULT):
+        # Callers hold a slot of the semaphore; a streamed response must be closed by the caller
+        if not self.breaker.allow():
+            raise CircuitOpenError("AI upstream circuit is open")
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            retry_after = None
+            try:
+                request = self.http.build_request("POST", self.url, json=payload, timeout=timeout)
+                response = await self.http.send(request, stream=stream)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                last_error = e
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                if attempt < self.max_retries:
+                    await response.aclose()
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+        self.breaker.record_failure()
+        if response is not None:
+            return response
+        raise last_error
+
+    async def _acall(self, sys_prompt, history, message):
+        try:
+            async with self.semaphore:
+                response = await self._apost(self.build_payload(sys_prompt, history, message))
+        except CircuitOpenError:
+            return "Error: AI service is temporarily unavailable"
+        except httpx.HTTPError as e:
+            return f"Error: {e.__class__.__name__} {e}"
+
+        if response.status_code == 200:
+            result = response.json()
+            return result["choices"][0]["message"]["content"]
+        else:
+            return f"Error: {response.status_code} {response.text}"
+
+    async def acall(self, sys_prompt, history, message):
+        future = asyncio.run_coroutine_threadsafe(self._acall(sys_prompt, history, message), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def call(self, sys_prompt, history, message, timeout=None):
+        # Blocking bridge for sync callers that should still share the async limits;
+        # `timeout` bounds the whole call, including retries and waiting for a slot
+        future = asyncio.run_coroutine_threadsafe(self._acall(sys_prompt, history, message), self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return f"Error: Timeout no response within {timeout}s"
+
+    async def _astream(self, payload, chunks, stopped, timeout=None):
+        # Keeps its concurrency slot until the whole stream is read; None on `chunks` marks the end.
+        # The reader sets `stopped` to give up early; cancelling instead could strand the
+        # pooled connection mid-response.
+        try:
+            async with self.semaphore:
+                if stopped.is_set():
+                    return
+                try:
+                    response = await self._apost(payload, stream=True,
+                                                 timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+                except CircuitOpenError:
+                    chunks.put("Error: AI service is temporarily unavailable")
+                    return
+                except httpx.HTTPError as e:
+                    chunks.put(f"Error: {e.__class__.__name__} {e}")
+                    return
+                try:
+                    if response.status_code != 200:
+                        await response.aread()
+                        chunks.put(f"Error: {response.status_code} {response.text}")
+                        return
+                    async for line in response.aiter_lines():
+                        delta = sse_delta(line)
+                        if delta is None or stopped.is_set():
+                            break
+                        if delta:
+                            chunks.put(delta)
+                except httpx.HTTPError as e:
+                    chunks.put(f"Error: {e.__class__.__name__} {e}")
+                finally:
+                    await response.aclose()
+        finally:
+            chunks.put(None)
+
+    def stream(self, sys_prompt, history, message, timeout=None):
+        """Like AIClient.stream, but under the process-wide concurrency and rate limits.
+
+        Closing the generator early (the browser went away) ends the request
+        at the next line received and frees its slot.
+        """
+        payload = self.build_payload(sys_prompt, history, message)
+        payload["stream"] = True
+        chunks, stopped = queue.Queue(), threading.Event()
+        asyncio.run_coroutine_threadsafe(self._astream(payload, chunks, stopped, timeout), self._ensure_loop())
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            stopped.set()
+
+
+client = AIClient()
+
+async_client = AsyncAIClient(
+    max_concurrency=int(os.environ.get("AI_MAX_CONCURRENCY", 32)),
+    rate_per_second=float(os.environ.get("AI_RATE_PER_SECOND", 5)),
+    burst=int(os.environ.get("AI_RATE_BURST", 10)),
+)
+
+
 def call (sys_prompt, history, message):
-    global data
-    data = {
-     "model": "meta-llama/llama-4-maverick:free",  # You can choose any model available on OpenRouter
-        "messages": [
-            {"role": "system", "content": sys_prompt},
-            {"role": "system", "content": f"This is the previous history for the user that you should keep context of while generating: {history}"},
-            {"role": "user", "content": message },
-        ]
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-
-    if response.status_code == 200:
-        result = response.json()
-        return result["choices"][0]["message"]["content"]
-    else:
-        return f"Error: {response.status_code} {response.text}"
+    return client.call(sys_prompt, history, message)
+
+
+def stream_call(sys_prompt, history, message):
+    return client.stream(sys_prompt, history, message)
+
+
+async def acall(sys_prompt, history, message):
+    return await async_client.acall(sys_prompt, history, message)
+
+
+def call_limited(sys_prompt, history, message):
+    return async_client.call(sys_prompt, history, message)
+
+
+def stream_limited(sys_prompt, history, message):
+    return async_client.stream(sys_prompt, history, message)
 """
 # example useage of call function
 with open ("diet_coach_prompt.txt", "r") as f:
@@ -7,21 +7,41 @@ from flask import (
     session,
     flash,
     jsonify,
-    send_from_directory
+    send_from_directory,
+    Response,
+    stream_with_context
 )
 import os
-from cs50 import SQL
+from chat_context import RECENT_TURNS_SQL, SUMMARY_SQL, UNFOLDED_TURNS_SQL, ChatHistory
+from database import SQL
+from werkzeug.exceptions import TooManyRequests
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from ai_caller import call
+from ai_caller import MODEL, call, call_limited, stream_call, stream_limited
+from jobs import JobFailed, JobQueue
+from migrations import migrate
+from plan_cache import PlanCache, cache_key
+from pregenerate import EXISTING_PLAN_SQL, PlanPregenerator
+from plan_parser import (DAY_NAMES, PLAN_SCHEMAS, PlanParseError, broken_days, format_errors, merge_days,
+                         parse_plan, parse_slice, repair_request, slice_request, validate)
+from plan_store import PLAN_TABLES, archive_plans, decode_plan, store_plan, week_start as plan_week_start
+from profile_cache import ProfileCache
+from downsample import downsample_series
+from bmi import calculate_bmi, get_bmi_category, measure_many
+from bmi_import import DEFAULT_CHUNK_SIZE as BMI_IMPORT_CHUNK_SIZE, detect_format, import_bmi_records, read_rows
+from ratelimit import DailyQuota, QuotaExceeded, RateLimited, RateLimiter
+from rollups import (LATEST_BMI_SQL, SUMMARY_FIRST_SQL, SUMMARY_LAST_SQL, SUMMARY_TOTALS_SQL, bmi_summary,
+                     latest_bmi as latest_bmi_record, rebuild_rollups, record_bmi)
+import hashlib
 import json
 import os
 import subprocess
 import time
 from urllib.parse import urlparse
 import traceback
+import click
 
 # Ensure login_required is defined before any route uses it
 def login_required(f):
@@ -43,134 +63,97 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 with open ("diet_coach_prompt.txt", "r") as f:
     DIET_COACH_SYSTEM_PROMPT = f.read()
+# AI_ASYNC=1 routes AI calls through the asyncio client so every worker
+# shares one concurrency limit and provider rate limit
+AI_ASYNC = os.environ.get("AI_ASYNC", "0") == "1"
+def ai_call(sys_prompt, history, message):
+    if AI_ASYNC:
+        return call_limited(sys_prompt=sys_prompt, history=history, message=message)
+    return call(sys_prompt=sys_prompt, history=history, message=message)
+def ai_stream(sys_prompt, history, message):
+    if AI_ASYNC:
+        return stream_limited(sys_prompt=sys_prompt, history=history, message=message)
+    return stream_call(sys_prompt=sys_prompt, history=history, message=message)
 # Initialize CS50 SQL database
 db = SQL("sqlite:///health.db")
+plan_cache = PlanCache(
+    db,
+    ttl_seconds=int(os.environ.get("PLAN_CACHE_TTL", 7 * 24 * 3600)),
+    max_entries=int(os.environ.get("PLAN_CACHE_MAX_ENTRIES", 5000))
+)
+# (requests per minute, burst) per user for each rate-limited route group
+RATE_LIMITS = {"chat": (10, 5), "plan": (4, 2), "import": (2, 2)}
+rate_limiter = RateLimiter()
+ai_quota = DailyQuota(db, limit=int(os.environ.get("AI_DAILY_CALL_LIMIT", 100)))
+def rate_limited(route, ai=False):
+    # Goes under @login_required; `ai` routes are turned away once the daily AI
+    # quota is used up. The quota is charged later, only when a model call happens.
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            per_minute, burst = RATE_LIMITS[route]
+            rate_limiter.hit((session["user_id"], route), per_minute, burst)
+            if ai:
+                ai_quota.check(session["user_id"])
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+def charge_job_quota(user_id):
+    # Background jobs cannot answer 429; the status endpoint reports the code instead
+    try:
+        ai_quota.charge(user_id)
+    except QuotaExceeded as e:
+        raise JobFailed("quota_exceeded") from e
+@app.errorhandler(RateLimited)
+def too_many_requests(e):
+    if request.accept_mimetypes.best == "text/html":
+        return TooManyRequests(str(e), retry_after=e.retry_after).get_response()
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
 
 # Initialize Database Tables
 def init_db():
-    # Weekly Workout Plans table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS weekly_workout_plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            week_start_date DATE NOT NULL,
-            plan_data TEXT NOT NULL,
-            completed_items TEXT DEFAULT '{}',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-    # Users table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    # BMI Records table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS bmi_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            weight REAL NOT NULL,
-            height REAL NOT NULL,
-            bmi REAL NOT NULL,
-            category TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-
-    # Chat Messages table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            message TEXT NOT NULL,
-            response TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-
-    # User Preferences table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            dietary_preferences TEXT DEFAULT '',
-            allergies TEXT DEFAULT '',
-            goals TEXT DEFAULT 'maintenance',
-            target_weight REAL,
-            gender TEXT DEFAULT '',
-            age INTEGER,
-            activity_level TEXT DEFAULT '',
-            previous_history TEXT DEFAULT '',
-            prefered_cuisine TEXT DEFAULT '',
-            meal_frequency TEXT DEFAULT '',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-
-    # Weekly Diet Plaminutesns table
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS weekly_diet_plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            week_start_date DATE NOT NULL,
-            plan_data TEXT NOT NULL,
-            completed_items TEXT DEFAULT '{}',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-
-    db.execute("""
-    CREATE TABLE IF NOT EXISTS user_connections (
-        user_id INTEGER NOT NULL,
-        friend_id INTEGER NOT NULL,
-        status TEXT NOT NULL DEFAULT 'pending',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (friend_id) REFERENCES users (id),
-        UNIQUE(user_id, friend_id),
-        CHECK(status IN ('pending', 'accepted', 'rejected'))
-    )
-    """)
+    applied = migrate(db)
+    if applied:
+        app.logger.info(f"Applied {applied} schema migration(s)")
+
+LATEST_PREFERENCES_SQL = """
+    SELECT * FROM user_preferences
+    WHERE user_id = ?
+    ORDER BY created_at DESC LIMIT 1
+"""
+LATEST_PREFERENCES_ID_SQL = """
+    SELECT id FROM user_preferences
+    WHERE user_id = ?
+    ORDER BY created_at DESC LIMIT 1
+"""
+def load_profile_context(user_id):
+    prefs = db.execute(LATEST_PREFERENCES_SQL, user_id)
+    return (latest_bmi_record(db, user_id), prefs[0] if prefs else None)
+
+# Latest BMI and preferences per user; invalidated by the calculator, BMI import and preferences writes
+profile_cache = ProfileCache(load_profile_context,
+                             ttl=float(os.environ.get("PROFILE_CACHE_TTL", 60)),
+                             max_users=int(os.environ.get("PROFILE_CACHE_SIZE", 1000)))
 
 # --- AI Workout Plan Generation ---
 with open ("workout_coach_prompt.txt", "r") as f:
     WORKOUT_COACH_SYSTEM_PROMPT = f.read()
 
-def generate_weekly_workout_plan_ai(user_id: int):
-    # Gather user profile
-    prefs = db.execute("""
-        SELECT gender, age, activity_level, previous_history, goals
-        FROM user_preferences
-        WHERE user_id = ?
-        ORDER BY created_at DESC LIMIT 1
-    """, user_id)
-    latest_bmi = db.execute("""
-        SELECT bmi, category FROM bmi_records
-        WHERE user_id = ?
-        ORDER BY created_at DESC LIMIT 1
-    """, user_id)
-    gender = prefs[0]["gender"] if prefs else ""
-    age = prefs[0]["age"] if prefs else None
-    activity_level = prefs[0]["activity_level"] if prefs else ""
-    previous_history = prefs[0]["previous_history"] if prefs else ""
-    goals = prefs[0]["goals"] if prefs else "general_fitness"
-    bmi = latest_bmi[0]["bmi"] if latest_bmi else None
-    bmi_category = latest_bmi[0]["category"] if latest_bmi else ""
-
-    # Compose AI prompt for call()
-    user_info = json.dumps({
+def workout_plan_profile(user_id):
+    # Everything the workout prompt depends on
+    latest_bmi, prefs = profile_cache.get(user_id)
+    gender = prefs["gender"] if prefs else ""
+    age = prefs["age"] if prefs else None
+    activity_level = prefs["activity_level"] if prefs else ""
+    previous_history = prefs["previous_history"] if prefs else ""
+    goals = prefs["goals"] if prefs else "general_fitness"
+    bmi = latest_bmi["bmi"] if latest_bmi else None
+    bmi_category = latest_bmi["category"] if latest_bmi else ""
+
+    return {
         "gender": gender,
         "age": age,
         "activity_level": activity_level,
@@ -178,38 +161,43 @@ def generate_weekly_workout_plan_ai(user_id: int):
         "goals": goals,
         "bmi": bmi,
         "bmi_category": bmi_category
-    })
-    ai_response = call(
-        sys_prompt=WORKOUT_COACH_SYSTEM_PROMPT,
-        history=previous_history,
-        message=user_info
-    )
-    plan = extract_json_strict(ai_response)
-    if not plan or "week" not in plan:
-        raise ValueError("Workout AI returned invalid JSON plan")
-    today = datetime.now()
-    start_of_week = today - timedelta(days=today.weekday())
-    db.execute(
-        """
-        INSERT INTO weekly_workout_plans (user_id, week_start_date, plan_data, completed_items)
-        VALUES (?, ?, ?, ?)
-        """,
-        user_id, start_of_week.date(), json.dumps(plan, ensure_ascii=False), json.dumps({})
-    )
+    }
+def generate_weekly_workout_plan_ai(user_id: int, bypass_cache: bool = False, week_start=None,
+                                    charge_quota: bool = False):
+    profile = workout_plan_profile(user_id)
+    key = cache_key(WORKOUT_COACH_SYSTEM_PROMPT, profile, MODEL)
+    plan = None if bypass_cache else plan_cache.get(key)
+    if plan is None:
+        if charge_quota:
+            charge_job_quota(user_id)
+        plan = request_plan("workout", WORKOUT_COACH_SYSTEM_PROMPT, profile)
+        plan_cache.put(key, "workout", plan)
+    # One transaction, so archive-plans cannot prune the blob before the row points at it
+    with db.transaction():
+        db.execute(
+            """
+            INSERT INTO weekly_workout_plans (user_id, week_start_date, plan_hash)
+            VALUES (?, ?, ?)
+            """,
+            user_id, week_start or plan_week_start(), store_plan(db, plan)
+        )
     return plan
 # --- Workout Plan Routes ---
+# The user's plan for this week, with its blob; format with a PLAN_TABLES table
+CURRENT_PLAN_SQL = """
+    SELECT p.id, b.data FROM {table} p
+    JOIN plan_blobs b ON b.hash = p.plan_hash
+    WHERE p.user_id = ? AND p.week_start_date >= date('now', '-7 days')
+    ORDER BY p.created_at DESC LIMIT 1
+"""
 @app.route("/workout_plan")
 @login_required
 def workout_plan():
-    existing_plan = db.execute("""
-        SELECT * FROM weekly_workout_plans
-        WHERE user_id = ? AND week_start_date >= date('now', '-7 days')
-        ORDER BY created_at DESC LIMIT 1
-    """, session["user_id"])
+    existing_plan = db.execute(CURRENT_PLAN_SQL.format(table=PLAN_TABLES["workout"]), session["user_id"])
     if existing_plan:
-        plan_data = json.loads(existing_plan[0]["plan_data"])
-        completed_items = json.loads(existing_plan[0]["completed_items"] or "{}")
+        plan_data = decode_plan(existing_plan[0]["data"])
         plan_id = existing_plan[0]["id"]
+        completed_items = plan_completions("workout", plan_id)
     else:
         plan_data = None
         completed_items = {}
@@ -221,67 +209,29 @@ def workout_plan():
 
 @app.route("/generate_new_workout_plan", methods=["POST"])
 @login_required
+@rate_limited("plan", ai=True)
 def generate_new_workout_plan():
     try:
-        plan = generate_weekly_workout_plan_ai(session["user_id"])
-        if plan is None:
-            flash("No profile found. Please fill your preferences first.", "warning")
-        else:
-            flash("New AI workout plan generated!", "success")
+        bypass_cache = request.form.get("regenerate") == "1"
+        job_id = plan_jobs.enqueue("workout", session["user_id"],
+                                   dedupe_key=plan_request_key("workout", session["user_id"], bypass_cache),
+                                   bypass_cache=bypass_cache, charge_quota=True)
     except Exception as e:
-        app.logger.error(f"AI workout plan error: {e}")
+        app.logger.error(f"AI workout plan enqueue error: {e}")
+        if wants_json():
+            return jsonify({"error": "Failed to queue workout plan generation"}), 500
         flash("Failed to generate AI workout plan. Please try again.", "danger")
+        return redirect(url_for("workout_plan"))
+    if wants_json():
+        return jsonify({"job_id": job_id, "status": "queued",
+                        "status_url": url_for("plan_job_status", job_id=job_id)}), 202
+    flash("Your AI workout plan is being generated. Refresh in a moment to see it.", "info")
     return redirect(url_for("workout_plan"))
 
 # Helper Functions
-def calculate_bmi(weight, height):
-    height_m = height / 100
-    return round(weight / (height_m**2), 1)
-def get_bmi_category(bmi):
-    if bmi < 18.5:
-        return {
-            "category": "underweight",
-            "name": "Underweight",
-            "color": "#3a86ff",
-            "tip": """<strong>Underweight Advice:</strong><br>
-                    • Increase calorie intake with nutrient-dense foods<br>
-                    • Include protein-rich foods like eggs, chicken, beans<br>
-                    • Consider strength training 3x/week<br>
-                    • 🍳🥩💪""",
-        }
-    elif bmi < 24.9:
-        return {
-            "category": "normal",
-            "name": "Normal",
-            "color": "#06d6a0",
-            "tip": """<strong>Healthy Weight Tips:</strong><br>
-                    • Maintain balanced diet (fruits, veggies, whole grains)<br>
-                    • 150+ mins exercise weekly<br>
-                    • Stay hydrated (8 glasses/day)<br>
-                    • 🥗🏃‍♂️💧""",
-        }
-    elif bmi < 29.9:
-        return {
-            "category": "overweight",
-            "name": "Overweight",
-            "color": "#ffd166",
-            "tip": """<strong>Overweight Advice:</strong><br>
-                    • Aim for 1-2 lbs weight loss/week<br>
-                    • Increase physical activity (walking, cycling)<br>
-                    • Reduce sugary drinks and snacks<br>
-                    • 🚶‍♀️🚫🍰""",
-        }
-    else:
-        return {
-            "category": "obese",
-            "name": "Obese",
-            "color": "#ef476f",
-            "tip": """<strong>Obesity Advice:</strong><br>
-                    • Consult healthcare professional<br>
-                    • Focus on sustainable lifestyle changes<br>
-                    • Join support groups for motivation<br>
-                    • 👨‍⚕️🤝💚""",
-        }
+def wants_json():
+    # fetch() callers ask for JSON; plain form posts keep the redirect flow
+    return request.accept_mimetypes.best == "application/json"
 def clean_ai_response(response):
     response = re.sub(r"[★☆*]+", "", response)
     response = re.sub(r"\*\*(.*?)\*\*", r"<strong>\1</strong>", response)
@@ -291,69 +241,97 @@ def clean_ai_response(response):
 def check_ollama_service():
     # Ollama service is no longer used for AI responses
     return True, "AI service is now handled by OpenRouter via ai_caller.py."
+def build_chat_context(user_id):
+    bmi, _ = profile_cache.get(user_id)
+
+    bmi_context = ""
+    if bmi:
+        bmi_context = f"The user's BMI history is {bmi['bmi']} ({bmi['category'].lower()})."
+
+    system_prompt = (
+        f"You are Kinetic Edge, an AI health assistant specializing in nutrition, fitness, and weight management."
+        f"The user prefers to be called as {session['username']}, unless stated otherwise in the chat. Treat it as a nickname and don't take it repeatedly."
+        f"{bmi_context}Provide science-based, practical advice. Be encouraging and empathetic. Think and answer logically and not emotionally, while still showing empathy towards user, like an actual health coach."
+        "Keep responses concise and in the range of 2-3 sentences/ within 25-50 words except if longer responses are absolutely necessary."
+        "Keep your tone professional, like a true coach."
+    )
+
+    # Newest turns that fit the token budget, after a summary of older ones
+    history_str = chat_memory.build(user_id)
+    return system_prompt, history_str
+def chat_html(row, column):
+    # Rows written before the *_html columns existed are cleaned on the fly
+    # until `flask backfill-chat-html` has run
+    rendered = row.get(f"{column}_html")
+    return rendered if rendered is not None else clean_ai_response(row[column])
+def save_chat_message(user_id, message, response, response_html=None):
+    """Store the raw exchange together with its rendered form; returns the rendered response."""
+    if response_html is None:
+        response_html = clean_ai_response(response)
+    db.execute("""
+        INSERT INTO chat_messages (user_id, message, response, message_html, response_html)
+        VALUES (?, ?, ?, ?, ?)
+    """, user_id, message, response, clean_ai_response(message), response_html)
+    return response_html
 def generate_chat_response(user_message, user_id):
     try:
-        # Get latest BMI record
-        bmi = db.execute("""
-            SELECT bmi, category FROM bmi_records
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, user_id)
-
-        bmi_context = ""
-        if bmi:
-            bmi_context = f"The user's BMI history is {bmi[0]['bmi']} ({bmi[0]['category'].lower()})."
-
-        system_prompt = (
-            f"You are Kinetic Edge, an AI health assistant specializing in nutrition, fitness, and weight management."
-            f"The user prefers to be called as {session['username']}, unless stated otherwise in the chat. Treat it as a nickname and don't take it repeatedly."
-            f"{bmi_context}Provide science-based, practical advice. Be encouraging and empathetic. Think and answer logically and not emotionally, while still showing empathy towards user, like an actual health coach."
-            "Keep responses concise and in the range of 2-3 sentences/ within 25-50 words except if longer responses are absolutely necessary."
-            "Keep your tone professional, like a true coach."
-        )
-
-        # Get previous messages
-        previous_messages = db.execute("""
-            SELECT message, response FROM chat_messages
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT 10
-        """, user_id)
-
-        messages = [{"role": "system", "content": system_prompt}]
-        for msg in reversed(previous_messages):
-            messages.append({"role": "user", "content": clean_ai_response(msg["message"])})
-            messages.append({"role": "assistant", "content": clean_ai_response(msg["response"])})
-        messages.append({"role": "user", "content": user_message})
-
+        system_prompt, history_str = build_chat_context(user_id)
         # Use the call function from ai_caller.py
-        # Prepare history string from previous messages
-        history_str = "\n".join([
-            f"User: {clean_ai_response(msg['message'])}\nAI: {clean_ai_response(msg['response'])}"
-            for msg in reversed(previous_messages)
-        ])
-        ai_response = call(
+        return ai_call(
             sys_prompt=system_prompt,
             history=history_str,
             message=user_message
         )
-        return clean_ai_response(ai_response)
     except Exception as e:
         app.logger.error(f"Error generating chat response: {str(e)}")
         return "Sorry, I'm having trouble processing your request right now."
-
-JSON_BLOCK_RE = re.compile(r"\{.*\}", re.DOTALL)
-def extract_json_strict(text: str):
-    if not text:
-        return None
-    cleaned = text.strip()
-    cleaned = cleaned.replace("``````", "")
-    m = JSON_BLOCK_RE.search(cleaned)
-    if not m:
-        return None
-    block = m.group(0)
-    return json.loads(block)
+class IncrementalCleaner:
+    """Applies clean_ai_response to a token stream chunk by chunk.
+
+    The substitutions only look at a newline and the two characters after
+    it, so a short tail is held back until the next chunk shows whether it
+    starts a "\n- " bullet.
+    """
+
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk):
+        self.pending += chunk
+        cut = len(self.pending)
+        newline = self.pending.rfind("\n", max(0, cut - 2))
+        if newline != -1:
+            cut = newline
+        ready, self.pending = self.pending[:cut], self.pending[cut:]
+        return clean_ai_response(ready) if ready else ""
+
+    def flush(self):
+        ready, self.pending = self.pending, ""
+        return clean_ai_response(ready) if ready else ""
+
+def request_plan(kind, sys_prompt, profile):
+    """Ask the AI for a plan; days that come back broken are re-requested once on their own."""
+    plan, errors = parse_plan(kind, ai_call(
+        sys_prompt=sys_prompt,
+        history=profile["previous_history"],
+        message=json.dumps(profile)
+    ))
+    days = broken_days(errors)
+    if days:
+        app.logger.warning(f"Re-requesting {kind} plan days {days}: {format_errors(errors)}")
+        try:
+            patch, _ = parse_plan(kind, ai_call(
+                sys_prompt=sys_prompt,
+                history=profile["previous_history"],
+                message=json.dumps(profile) + "\n\n" + repair_request(days)
+            ))
+        except PlanParseError as e:
+            raise ValueError(f"{kind.capitalize()} AI returned an unusable repair: {e}") from e
+        plan = merge_days(plan, patch, days)
+        errors = validate(plan, PLAN_SCHEMAS[kind])
+    if errors:
+        raise ValueError(f"{kind.capitalize()} AI returned an invalid plan: {format_errors(errors)}")
+    return plan
 def calorie_hint(bmi_category: str, goals: str) -> str:
     cat = (bmi_category or "").lower()
     goal = (goals or "maintenance").lower()
@@ -365,39 +343,28 @@ def calorie_hint(bmi_category: str, goals: str) -> str:
     if goal == "weight_loss":
         return "1200-1800 kcal/day" if cat in ["overweight", "obese"] else "1500-1900 kcal/day"
     return "1800-2300 kcal/day" if cat in ["normal", "overweight"] else "2000-2400 kcal/day"
-def generate_weekly_diet_plan_ai(user_id: int):
-    latest_bmi = db.execute("""
-        SELECT weight, height, bmi, category, created_at
-        FROM bmi_records
-        WHERE user_id = ?
-        ORDER BY created_at DESC LIMIT 1
-    """, user_id)
+def diet_plan_profile(user_id):
+    # Everything the diet prompt depends on, or None without a BMI record
+    latest_bmi, prefs = profile_cache.get(user_id)
     if not latest_bmi:
         return None
-    bmi_val = latest_bmi[0]["bmi"]
-    bmi_cat = latest_bmi[0]["category"]
-
-    prefs = db.execute("""
-        SELECT dietary_preferences, allergies, goals, target_weight, gender, age, activity_level, previous_history, meal_frequency, prefered_cuisine
-        FROM user_preferences
-        WHERE user_id = ?
-        ORDER BY created_at DESC LIMIT 1
-    """, user_id)
-    dietary_preferences = prefs[0]["dietary_preferences"] if prefs else ""
-    allergies = prefs[0]["allergies"] if prefs else ""
-    goals = prefs[0]["goals"] if prefs else "maintenance"
-    target_weight = prefs[0]["target_weight"] if prefs else None
-    gender = prefs[0]["gender"] if prefs else ""
-    age = prefs[0]["age"] if prefs else None
-    activity_level = prefs[0]["activity_level"] if prefs else ""
-    previous_history = prefs[0]["previous_history"] if prefs else ""
-    meal_freq = prefs[0]["meal_frequency"] if prefs else ""
-    cuisine = prefs[0]["prefered_cuisine"] if prefs else ""
+    bmi_val = latest_bmi["bmi"]
+    bmi_cat = latest_bmi["category"]
+
+    dietary_preferences = prefs["dietary_preferences"] if prefs else ""
+    allergies = prefs["allergies"] if prefs else ""
+    goals = prefs["goals"] if prefs else "maintenance"
+    target_weight = prefs["target_weight"] if prefs else None
+    gender = prefs["gender"] if prefs else ""
+    age = prefs["age"] if prefs else None
+    activity_level = prefs["activity_level"] if prefs else ""
+    previous_history = prefs["previous_history"] if prefs else ""
+    meal_freq = prefs["meal_frequency"] if prefs else ""
+    cuisine = prefs["prefered_cuisine"] if prefs else ""
 
     calorie_range = calorie_hint(bmi_cat, goals)
 
-    # Compose AI prompt for call()
-    user_info = json.dumps({
+    return {
         "bmi": bmi_val,
         "bmi_category": bmi_cat,
         "goals": goals,
@@ -411,51 +378,165 @@ def generate_weekly_diet_plan_ai(user_id: int):
         "calorie_range_hint": calorie_range,
         "meal_frequency": meal_freq,
         "cuisine": cuisine
-    })
-    ai_response = call(
-        sys_prompt=DIET_COACH_SYSTEM_PROMPT,
-        history=previous_history,
-        message=user_info
-    )
-    plan = extract_json_strict(ai_response)
-    if not plan or "week" not in plan:
-        raise ValueError("Diet AI returned invalid JSON plan")
-    today = datetime.now()
-    start_of_week = today - timedelta(days=today.weekday())
-    db.execute(
-        """
-        INSERT INTO weekly_diet_plans (user_id, week_start_date, plan_data, completed_items)
-        VALUES (?, ?, ?, ?)
-        """,
-        user_id, start_of_week.date(), json.dumps(plan, ensure_ascii=False), json.dumps({})
-    )
+    }
+def generate_weekly_diet_plan_ai(user_id: int, bypass_cache: bool = False, week_start=None,
+                                 charge_quota: bool = False):
+    profile = diet_plan_profile(user_id)
+    if profile is None:
+        return None
+    key = cache_key(DIET_COACH_SYSTEM_PROMPT, profile, MODEL)
+    plan = None if bypass_cache else plan_cache.get(key)
+    if plan is None:
+        if charge_quota:
+            charge_job_quota(user_id)
+        plan = request_plan("diet", DIET_COACH_SYSTEM_PROMPT, profile)
+        plan_cache.put(key, "diet", plan)
+    # One transaction, so archive-plans cannot prune the blob before the row points at it
+    with db.transaction():
+        db.execute(
+            """
+            INSERT INTO weekly_diet_plans (user_id, week_start_date, plan_hash)
+            VALUES (?, ?, ?)
+            """,
+            user_id, week_start or plan_week_start(), store_plan(db, plan)
+        )
     return plan
-def get_bmi_chart_data(user_id):
-    records = db.execute("""
-        SELECT bmi, weight, height, created_at FROM bmi_records
-        WHERE user_id = ?
-        ORDER BY created_at ASC
-    """, user_id)
-
+def plan_request_key(kind, user_id, bypass_cache=False):
+    # Identical concurrent requests (double-clicks, several tabs) share one job
+    if kind == "diet":
+        profile, prompt = diet_plan_profile(user_id), DIET_COACH_SYSTEM_PROMPT
+    else:
+        profile, prompt = workout_plan_profile(user_id), WORKOUT_COACH_SYSTEM_PROMPT
+    digest = "no-profile" if profile is None else cache_key(prompt, profile, MODEL)
+    return f"{kind}:{user_id}:{digest}" + (":fresh" if bypass_cache else "")
+SLICE_MEALS = ("breakfast", "lunch", "dinner", "snacks")
+
+def slice_item_prefix(day, meal=None):
+    # Completion keys are "<day>_<meal>" and "<day>_snack_<n>"; see the plan templates
+    if meal is None:
+        return f"{day}_"
+    return f"{day}_snack_" if meal == "snacks" else f"{day}_{meal}"
+
+def regenerate_plan_slice(user_id, plan_type, plan_id, day, meal=None, charge_quota=False):
+    """Replace one day (or one meal of a day) in a stored plan with a fresh AI suggestion.
+
+    Only the slice being replaced and the plan's own constraints are sent, not
+    the whole week. Returns the new slice, or None when the profile is incomplete.
+    """
+    kind, table = ("diet" if plan_type == "meal" else "workout"), PLAN_TABLES[plan_type]
+    if kind == "diet":
+        profile, prompt = diet_plan_profile(user_id), DIET_COACH_SYSTEM_PROMPT
+    else:
+        profile, prompt = workout_plan_profile(user_id), WORKOUT_COACH_SYSTEM_PROMPT
+    if profile is None:
+        return None
+    rows = db.execute(f"""
+        SELECT b.data FROM {table} p JOIN plan_blobs b ON b.hash = p.plan_hash
+        WHERE p.id = ? AND p.user_id = ?
+    """, plan_id, user_id)
+    if not rows:
+        raise ValueError(f"Plan {plan_id} not found")
+    plan = decode_plan(rows[0]["data"])
+    current = plan.get("week", {}).get(day, {})
+    context = {
+        "profile": profile,
+        "calories_target": plan.get("calories_target"),
+        "rules": plan.get("rules"),
+        "replace": {"day": day, "meal": meal, "current": current.get(meal) if meal else current},
+    }
+    if charge_quota:
+        charge_job_quota(user_id)
+    reply = ai_call(
+        sys_prompt=prompt,
+        history=profile["previous_history"],
+        message=json.dumps(context) + "\n\n" + slice_request(day, meal)
+    )
+    try:
+        value = parse_slice(kind, reply, day, meal)
+    except PlanParseError as e:
+        raise ValueError(f"{kind.capitalize()} AI returned an invalid {meal or 'day'} for {day}: {e}") from e
+
+    with db.transaction():
+        # Re-read inside the transaction so a concurrent slice update is not overwritten
+        rows = db.execute(f"""
+            SELECT b.data FROM {table} p JOIN plan_blobs b ON b.hash = p.plan_hash
+            WHERE p.id = ? AND p.user_id = ?
+        """, plan_id, user_id)
+        if not rows:
+            raise ValueError(f"Plan {plan_id} not found")
+        plan = decode_plan(rows[0]["data"])
+        week = plan.setdefault("week", {})
+        if meal is None:
+            week[day] = value
+        else:
+            week.setdefault(day, {})[meal] = value
+        plan["week"] = {name: week[name] for name in DAY_NAMES if name in week}
+        db.execute(f"UPDATE {table} SET plan_hash = ?, version = version + 1 WHERE id = ?",
+                   store_plan(db, plan), plan_id)
+        # Ticks on the replaced items no longer refer to anything
+        prefix = slice_item_prefix(day, meal)
+        db.execute("""
+            DELETE FROM plan_item_completions
+            WHERE plan_type = ? AND plan_id = ? AND substr(item_key, 1, ?) = ?
+        """, plan_type, plan_id, len(prefix), prefix)
+    return value
+def chart_date(created_at):
+    # created_at is 'YYYY-MM-DD HH:MM:SS'; slicing avoids a strptime per row
+    if isinstance(created_at, str):
+        return f"{created_at[5:7]}/{created_at[8:10]}"
+    return created_at.strftime('%m/%d')
+CHART_SERIES_SQL = """
+    SELECT user_id, bmi, weight, height, created_at FROM bmi_records
+    WHERE user_id IN (?)
+      AND created_at >= COALESCE(?, '0000-01-01')
+      AND created_at < COALESCE(date(?, '+1 day'), '9999-12-31')
+    ORDER BY user_id, created_at ASC
+"""
+def get_bmi_chart_data_bulk(user_ids, start=None, end=None):
+    """Chart series for several users from a single ordered query, keyed by user id.
+
+    `start`/`end` are optional 'YYYY-MM-DD' bounds (end inclusive).
+    """
     chart_data = {
-        "dates": [],
-        "bmi_values": [],
-        "weights": [],
-        "heights": []
+        user_id: {"dates": [], "bmi_values": [], "weights": [], "heights": []}
+        for user_id in user_ids
     }
+    if not chart_data:
+        return chart_data
+    records = db.execute(CHART_SERIES_SQL, list(chart_data), start, end)
 
     for record in records:
-        if isinstance(record["created_at"], str):
-            date_obj = datetime.strptime(record["created_at"], '%Y-%m-%d %H:%M:%S')
-        else:
-            date_obj = record["created_at"]
-
-        chart_data["dates"].append(date_obj.strftime('%m/%d'))
-        chart_data["bmi_values"].append(record["bmi"])
-        chart_data["weights"].append(record["weight"])
-        chart_data["heights"].append(record["height"])
+        data = chart_data[record["user_id"]]
+        data["dates"].append(chart_date(record["created_at"]))
+        data["bmi_values"].append(record["bmi"])
+        data["weights"].append(record["weight"])
+        data["heights"].append(record["height"])
 
     return chart_data
+def pad_chart_data(all_chart_data):
+    """Extend every series to the longest one by repeating its last point on following days."""
+    max_len = max((len(data["dates"]) for data in all_chart_data.values()), default=0)
+    for data in all_chart_data.values():
+        missing = max_len - len(data["dates"])
+        if missing <= 0:
+            continue
+        if data["dates"]:
+            # Parse in a leap year so 02/29 round-trips
+            last_date = datetime.strptime(f"2000/{data['dates'][-1]}", '%Y/%m/%d')
+            last_bmi = data["bmi_values"][-1]
+            last_weight = data["weights"][-1]
+            last_height = data["heights"][-1]
+        else:
+            # If user has no data, use default values
+            last_date = datetime.now()
+            last_bmi = 0
+            last_weight = 0
+            last_height = 0
+        data["dates"].extend([(last_date + timedelta(days=i)).strftime('%m/%d') for i in range(1, missing + 1)])
+        data["bmi_values"].extend([last_bmi] * missing)
+        data["weights"].extend([last_weight] * missing)
+        data["heights"].extend([last_height] * missing)
+    return all_chart_data
 ## login_required decorator is already defined above all usages, so remove this duplicate
 # Routes
 @app.route("/")
@@ -520,30 +601,26 @@ def logout():
 @app.route("/dashboard")
 @login_required
 def dashboard():
-    latest_bmi = db.execute("""
-        SELECT * FROM bmi_records
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT 1
-    """, session["user_id"])
-    if latest_bmi:
-        latest_record = latest_bmi[0]
+    latest_record, _ = profile_cache.get(session["user_id"])
+    if latest_record:
         if 'created_at' in latest_record and isinstance(latest_record['created_at'], str):
             try:
                 latest_record['created_at'] = datetime.strptime(latest_record['created_at'], '%Y-%m-%d %H:%M:%S')
             except ValueError:
                 app.logger.error("Failed to parse created_at in dashboard")
-    else:
-        latest_record = None
     return render_template("dashboard.html", latest_bmi=latest_record)
+CALCULATOR_HISTORY_LIMIT = 50
+CALCULATOR_HISTORY_SQL = """
+    SELECT * FROM bmi_records
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
 @app.route("/calculator", methods=["GET", "POST"])
 @login_required
 def calculator():
-    records = db.execute("""
-        SELECT * FROM bmi_records
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    """, session["user_id"])
+    records = db.execute(CALCULATOR_HISTORY_SQL, session["user_id"], CALCULATOR_HISTORY_LIMIT)
+    stats = bmi_summary(db, session["user_id"])
 
     for record in records:
         if 'created_at' in record and isinstance(record['created_at'], str):
@@ -561,10 +638,15 @@ def calculator():
                 return redirect(url_for("calculator"))
             bmi = calculate_bmi(weight, height)
             category_data = get_bmi_category(bmi)
-            db.execute("""
-                INSERT INTO bmi_records (user_id, weight, height, bmi, category)
-                VALUES (?, ?, ?, ?, ?)
-            """, session["user_id"], weight, height, bmi, category_data["name"])
+            # Same UTC format as CURRENT_TIMESTAMP, shared with the rollup row
+            created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            with db.transaction():
+                db.execute("""
+                    INSERT INTO bmi_records (user_id, weight, height, bmi, category, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, session["user_id"], weight, height, bmi, category_data["name"], created_at)
+                record_bmi(db, session["user_id"], created_at, weight, height, bmi, category_data["name"])
+            profile_cache.invalidate(session["user_id"])
             flash("BMI calculation saved!", "success")
             return redirect(url_for("calculator"))
         except ValueError:
@@ -572,37 +654,105 @@ def calculator():
         except Exception as e:
             app.logger.error(f"Error saving BMI record: {str(e)}")
             flash("An error occurred while saving your BMI data", "danger")
-    return render_template("calculator.html", records=records)
-@app.route("/chat")
+    return render_template("calculator.html", records=records, stats=stats)
+
+@app.route("/import_bmi", methods=["POST"])
 @login_required
-def chat():
-    messages = db.execute("""
-        SELECT * FROM chat_messages
-        WHERE user_id = ?
-        ORDER BY created_at ASC
-    """, session["user_id"])
+@rate_limited("import")
+def import_bmi():
+    upload = request.files.get("file")
+    counts, error = None, None
+    if not upload or not upload.filename:
+        error = "Choose a CSV or JSON file to import"
+    else:
+        try:
+            rows = read_rows(upload.stream, detect_format(upload.filename))
+            counts = import_bmi_records(db, session["user_id"], rows, measure_many)
+        except ValueError as e:
+            error = f"Could not read the file: {e}"
+        except Exception as e:
+            app.logger.error(f"Error importing BMI records: {str(e)}")
+            error = "An error occurred while importing your BMI data"
+        finally:
+            # Chunks commit one by one, so even a failed import may have added records
+            profile_cache.invalidate(session["user_id"])
+    if wants_json():
+        if error:
+            return jsonify({"success": False, "error": error}), 400
+        return jsonify({"success": True, **counts})
+    if error:
+        flash(error, "danger")
+    else:
+        flash(f"Imported {counts['imported']} records "
+              f"({counts['duplicates']} already recorded, {counts['skipped']} invalid rows skipped)", "success")
+    return redirect(url_for("calculator"))
+CHAT_PAGE_SIZE = 20
+CHAT_PAGE_MAX = 100
+CHAT_PAGE_SQL = """
+    SELECT id, message, response, message_html, response_html, created_at FROM chat_messages
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+CHAT_PAGE_BEFORE_SQL = """
+    SELECT id, message, response, message_html, response_html, created_at FROM chat_messages
+    WHERE user_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+def fetch_chat_page(user_id, before_id=None, limit=CHAT_PAGE_SIZE):
+    # Keyset pagination on id; one extra row tells us whether older messages exist
+    if before_id is None:
+        rows = db.execute(CHAT_PAGE_SQL, user_id, limit + 1)
+    else:
+        rows = db.execute(CHAT_PAGE_BEFORE_SQL, user_id, before_id, limit + 1)
+    has_more = len(rows) > limit
+    messages = list(reversed(rows[:limit]))
 
     for message in messages:
+        message['message'] = chat_html(message, 'message')
+        message['response'] = chat_html(message, 'response')
         if 'created_at' in message and isinstance(message['created_at'], str):
             try:
                 message['created_at'] = datetime.strptime(message['created_at'], '%Y-%m-%d %H:%M:%S')
-                message['message'] = clean_ai_response(message['message'])
             except ValueError:
                 app.logger.error("Failed to parse created_at in chat")
-    return render_template("chat.html", messages=messages)
+    return messages, has_more
+@app.route("/chat")
+@login_required
+def chat():
+    messages, has_more = fetch_chat_page(session["user_id"])
+    return render_template("chat.html", messages=messages, has_more=has_more)
+@app.route("/chat_history")
+@login_required
+def chat_history():
+    before_id = request.args.get("before_id", type=int)
+    limit = request.args.get("limit", CHAT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    messages, has_more = fetch_chat_page(session["user_id"], before_id, limit)
+    return jsonify({
+        "messages": [
+            {
+                "id": message["id"],
+                "message": message["message"],
+                "response": message["response"],
+                "time": message["created_at"].strftime('%H:%M') if isinstance(message["created_at"], datetime) else message["created_at"],
+            }
+            for message in messages
+        ],
+        "has_more": has_more
+    })
 @app.route("/send_message", methods=["POST"])
 @login_required
+@rate_limited("chat", ai=True)
 def send_message():
     user_id = session["user_id"]
     message = request.form.get("message", "").strip()
     if not message:
         return jsonify({"error": "Message cannot be empty"}), 400
+    ai_quota.charge(user_id)
     try:
-        response = generate_chat_response(message, user_id)
-        db.execute("""
-            INSERT INTO chat_messages (user_id, message, response)
-            VALUES (?, ?, ?)
-        """, user_id, message, response)
+        response = save_chat_message(user_id, message, generate_chat_response(message, user_id))
         return jsonify(
             {
                 "message": message,
@@ -614,32 +764,106 @@ def send_message():
         app.logger.error(f"Error processing message: {str(e)}")
         return jsonify({"error": "Failed to process message"}), 500
 
+@app.route("/send_message_stream", methods=["POST"])
+@login_required
+@rate_limited("chat", ai=True)
+def send_message_stream():
+    user_id = session["user_id"]
+    message = request.form.get("message", "").strip()
+    if not message:
+        return jsonify({"error": "Message cannot be empty"}), 400
+    ai_quota.charge(user_id)
+    try:
+        system_prompt, history_str = build_chat_context(user_id)
+    except Exception as e:
+        app.logger.error(f"Error preparing chat stream: {str(e)}")
+        return jsonify({"error": "Failed to process message"}), 500
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    def generate():
+        cleaner = IncrementalCleaner()
+        raw = []
+        parts = []
+        try:
+            for chunk in ai_stream(sys_prompt=system_prompt, history=history_str, message=message):
+                raw.append(chunk)
+                cleaned = cleaner.feed(chunk)
+                if cleaned:
+                    parts.append(cleaned)
+                    yield sse("delta", {"text": cleaned})
+            tail = cleaner.flush()
+            if tail:
+                parts.append(tail)
+                yield sse("delta", {"text": tail})
+            response = save_chat_message(user_id, message, "".join(raw), "".join(parts))
+            yield sse("done", {
+                "message": message,
+                "response": response,
+                "timestamp": datetime.now().strftime("%H:%M"),
+            })
+        except Exception as e:
+            app.logger.error(f"Error streaming message: {str(e)}")
+            yield sse("error", {"error": "Failed to process message"})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route("/generate_new_plan", methods=["POST"])
 @login_required
+@rate_limited("plan", ai=True)
 def generate_new_plan():
     try:
-        plan = generate_weekly_diet_plan_ai(session["user_id"])
-        if plan is None:
-            flash("No BMI found. Calculate BMI first.", "warning")
-        else:
-            flash("New AI meal plan generated!", "success")
+        bypass_cache = request.form.get("regenerate") == "1"
+        job_id = plan_jobs.enqueue("diet", session["user_id"],
+                                   dedupe_key=plan_request_key("diet", session["user_id"], bypass_cache),
+                                   bypass_cache=bypass_cache, charge_quota=True)
     except Exception as e:
-        app.logger.error(f"AI meal plan error: {e}")
+        app.logger.error(f"AI meal plan enqueue error: {e}")
+        if wants_json():
+            return jsonify({"error": "Failed to queue meal plan generation"}), 500
         flash("Failed to generate AI meal plan. Please try again.", "danger")
+        return redirect(url_for("meal_plan"))
+    if wants_json():
+        return jsonify({"job_id": job_id, "status": "queued",
+                        "status_url": url_for("plan_job_status", job_id=job_id)}), 202
+    flash("Your AI meal plan is being generated. Refresh in a moment to see it.", "info")
     return redirect(url_for("meal_plan"))
+
+@app.route("/plan_job/<int:job_id>")
+@login_required
+def plan_job_status(job_id):
+    job = plan_jobs.get(job_id, session["user_id"])
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    message = None
+    if job["status"] == "failed":
+        if job["error"] == "missing_profile":
+            message = ("No BMI found. Calculate BMI first." if job["kind"].startswith("diet")
+                       else "No profile found. Please fill your preferences first.")
+        elif job["error"] == "quota_exceeded":
+            message = f"Daily AI limit of {ai_quota.limit} requests reached, try again tomorrow"
+        else:
+            message = "Failed to generate AI plan. Please try again."
+    return jsonify({
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "message": message
+    })
 @app.route("/meal_plan")
 @login_required
 def meal_plan():
-    existing_plan = db.execute("""
-        SELECT * FROM weekly_diet_plans
-        WHERE user_id = ? AND week_start_date >= date('now', '-7 days')
-        ORDER BY created_at DESC LIMIT 1
-    """, session["user_id"])
+    existing_plan = db.execute(CURRENT_PLAN_SQL.format(table=PLAN_TABLES["meal"]), session["user_id"])
 
     if existing_plan:
-        plan_data = json.loads(existing_plan[0]["plan_data"])
-        completed_items = json.loads(existing_plan[0]["completed_items"] or "{}")
+        plan_data = decode_plan(existing_plan[0]["data"])
         plan_id = existing_plan[0]["id"]
+        completed_items = plan_completions("meal", plan_id)
     else:
         plan_data = None
         completed_items = {}
@@ -705,149 +929,159 @@ def preferences():
             if goals not in valid_goals:
                 goals = "maintenance"
 
-            # Check if user already has preferences
-            try:
-                existing_prefs = db.execute("""
-                    SELECT id FROM user_preferences
-                    WHERE user_id = ?
-                    ORDER BY created_at DESC LIMIT 1
-                """, session["user_id"])
+            # Read and upsert in one short write transaction
+            with db.transaction():
+                # Check if user already has preferences
+                existing_prefs = db.execute(LATEST_PREFERENCES_ID_SQL, session["user_id"])
                 logger.info(f"Found existing preferences: {existing_prefs}")
-            except Exception as e:
-                if "no such table" in str(e).lower():
-                    # Recreate the table if it doesn't exist
-                    logger.info("Preferences table not found, creating it...")
-                    db.execute("""
-                        CREATE TABLE IF NOT EXISTS user_preferences (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER NOT NULL,
-                            dietary_preferences TEXT DEFAULT '',
-                            allergies TEXT DEFAULT '',
-                            goals TEXT DEFAULT 'maintenance',
-                            target_weight REAL,
-                            prefered_cuisine TEXT DEFAULT '',
-                            meal_frequency TEXT DEFAULT '',
-                            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users (id)
-                        )
-                    """)
-                    existing_prefs = []
-                else:
-                    raise
 
-            if existing_prefs:
-                # Update existing preferences
-                try:
-                    app.logger.info(f"Updating existing preferences with ID {existing_prefs[0]['id']}")
-                    verify = db.execute("SELECT id FROM user_preferences WHERE id = ? AND user_id = ?",
-                                      existing_prefs[0]["id"], session["user_id"])
-                    if not verify:
-                        app.logger.error("Preference record not found during update")
-                        flash("Unable to find your preferences. Please try again.", "danger")
+                if existing_prefs:
+                    # Update existing preferences
+                    try:
+                        app.logger.info(f"Updating existing preferences with ID {existing_prefs[0]['id']}")
+                        verify = db.execute("SELECT id FROM user_preferences WHERE id = ? AND user_id = ?",
+                                          existing_prefs[0]["id"], session["user_id"])
+                        if not verify:
+                            app.logger.error("Preference record not found during update")
+                            flash("Unable to find your preferences. Please try again.", "danger")
+                            return redirect(url_for("preferences"))
+                        update_params = {
+                            "diet": dietary_preferences,
+                            "allergies": allergies,
+                            "goals": goals,
+                            "weight": target_weight_float if target_weight_float is not None else None,
+                            "gender": gender,
+                            "age": age_int,
+                            "activity_level": activity_level,
+                            "previous_history": previous_history,
+                            "prefered_cuisines": prefered_cuisine,  # Add this line
+                            "meal_frequency": meal_freq,
+                            "pref_id": existing_prefs[0]["id"],
+                            "user_id": session["user_id"]
+                        }
+                        app.logger.info(f"Executing update with params: {update_params}")
+                        update_query = """
+                                        UPDATE user_preferences
+                                        SET dietary_preferences = :diet,
+                                            allergies = :allergies,
+                                            goals = :goals,
+                                            target_weight = :weight,
+                                            gender = :gender,
+                                            age = :age,
+                                            prefered_cuisine = :prefered_cuisines,
+                                            meal_frequency = :meal_frequency,
+                                            activity_level = :activity_level,
+                                            previous_history = :previous_history,
+                                            updated_at = CURRENT_TIMESTAMP
+                                        WHERE id = :pref_id AND user_id = :user_id
+                                    """
+                        result = db.execute(update_query, **update_params)
+                        app.logger.info(f"Update completed successfully")
+                        flash("Preferences updated successfully!", "success")
+                        return redirect(url_for("preferences"))
+                    except Exception as e:
+                        error_msg = str(e)
+                        app.logger.error(f"Database update error: {error_msg}")
+                        app.logger.error(traceback.format_exc())
+                        if "UNIQUE constraint" in error_msg:
+                            flash("These preferences already exist.", "danger")
+                        elif "FOREIGN KEY constraint" in error_msg:
+                            flash("User session expired. Please log in again.", "danger")
+                            return redirect(url_for("login"))
+                        else:
+                            flash(f"An error occurred while updating your preferences: {error_msg}", "danger")
+                        return redirect(url_for("preferences"))
+                else:
+                    # Insert new preferences
+                    try:
+                        app.logger.info("Creating new preferences record")
+                        insert_params = {
+                            "user_id": session["user_id"],
+                            "diet": dietary_preferences,
+                            "allergies": allergies,
+                            "goals": goals,
+                            "weight": target_weight_float if target_weight_float is not None else None,
+                            "gender": gender,
+                            "age": age_int,
+                            "activity_level": activity_level,
+                            "previous_history": previous_history,
+                            "meal_frequency": meal_freq,
+                            "prefered_cuisine": prefered_cuisine
+                        }
+                        app.logger.info(f"Executing insert with params: {insert_params}")
+                        insert_query = """
+                            INSERT INTO user_preferences
+                            (user_id, dietary_preferences, allergies, goals, target_weight, gender, age, activity_level, previous_history, meal_frequency, prefered_cuisine)
+                            VALUES (:user_id, :diet, :allergies, :goals, :weight, :gender, :age, :activity_level, :previous_history, :meal_frequency, :prefered_cuisine)
+                        """
+                        result = db.execute(insert_query, **insert_params)
+                        app.logger.info("Insert completed successfully")
+                        flash("Preferences saved successfully!", "success")
+                        return redirect(url_for("preferences"))
+                    except Exception as e:
+                        app.logger.error(f"Database insert error: {str(e)}")
+                        app.logger.error(traceback.format_exc())
+                        flash("An error occurred while saving your preferences. Please try again.", "danger")
                         return redirect(url_for("preferences"))
-                    update_params = {
-                        "diet": dietary_preferences,
-                        "allergies": allergies,
-                        "goals": goals,
-                        "weight": target_weight_float if target_weight_float is not None else None,
-                        "gender": gender,
-                        "age": age_int,
-                        "activity_level": activity_level,
-                        "previous_history": previous_history,
-                        "prefered_cuisines": prefered_cuisine,  # Add this line
-                        "meal_frequency": meal_freq,
-                        "pref_id": existing_prefs[0]["id"],
-                        "user_id": session["user_id"]
-                    }
-                    app.logger.info(f"Executing update with params: {update_params}")
-                    update_query = """
-                                    UPDATE user_preferences
-                                    SET dietary_preferences = :diet,
-                                        allergies = :allergies,
-                                        goals = :goals,
-                                        target_weight = :weight,
-                                        gender = :gender,
-                                        age = :age,
-                                        prefered_cuisine = :prefered_cuisines,
-                                        meal_frequency = :meal_frequency,
-                                        activity_level = :activity_level,
-                                        previous_history = :previous_history,
-                                        updated_at = CURRENT_TIMESTAMP
-                                    WHERE id = :pref_id AND user_id = :user_id
-                                """
-                    result = db.execute(update_query, **update_params)
-                    app.logger.info(f"Update completed successfully")
-                    flash("Preferences updated successfully!", "success")
-                    return redirect(url_for("preferences"))
-                except Exception as e:
-                    error_msg = str(e)
-                    app.logger.error(f"Database update error: {error_msg}")
-                    app.logger.error(traceback.format_exc())
-                    if "UNIQUE constraint" in error_msg:
-                        flash("These preferences already exist.", "danger")
-                    elif "FOREIGN KEY constraint" in error_msg:
-                        flash("User session expired. Please log in again.", "danger")
-                        return redirect(url_for("login"))
-                    else:
-                        flash(f"An error occurred while updating your preferences: {error_msg}", "danger")
-                    return redirect(url_for("preferences"))
-            else:
-                # Insert new preferences
-                try:
-                    app.logger.info("Creating new preferences record")
-                    insert_params = {
-                        "user_id": session["user_id"],
-                        "diet": dietary_preferences,
-                        "allergies": allergies,
-                        "goals": goals,
-                        "weight": target_weight_float if target_weight_float is not None else None,
-                        "gender": gender,
-                        "age": age_int,
-                        "activity_level": activity_level,
-                        "previous_history": previous_history,
-                        "meal_frequency": meal_freq,
-                        "prefered_cuisine": prefered_cuisine
-                    }
-                    app.logger.info(f"Executing insert with params: {insert_params}")
-                    insert_query = """
-                        INSERT INTO user_preferences
-                        (user_id, dietary_preferences, allergies, goals, target_weight, gender, age, activity_level, previous_history, meal_frequency, prefered_cuisine)
-                        VALUES (:user_id, :diet, :allergies, :goals, :weight, :gender, :age, :activity_level, :previous_history, :meal_frequency, :prefered_cuisine)
-                    """
-                    result = db.execute(insert_query, **insert_params)
-                    app.logger.info("Insert completed successfully")
-                    flash("Preferences saved successfully!", "success")
-                    return redirect(url_for("preferences"))
-                except Exception as e:
-                    app.logger.error(f"Database insert error: {str(e)}")
-                    app.logger.error(traceback.format_exc())
-                    flash("An error occurred while saving your preferences. Please try again.", "danger")
-                    return redirect(url_for("preferences"))
         except Exception as e:
             app.logger.error(f"Unexpected error in preferences route: {str(e)}")
             app.logger.error(traceback.format_exc())
             flash("An unexpected error occurred. Please try again.", "danger")
             return redirect(url_for("preferences"))
+        finally:
+            # Runs after the write transaction has committed or rolled back
+            profile_cache.invalidate(session["user_id"])
 
     # Get existing preferences
     try:
-        preferences_data = db.execute("""
-            SELECT * FROM user_preferences
-            WHERE user_id = ?
-            ORDER BY updated_at DESC LIMIT 1
-        """, session["user_id"])
+        _, preferences_data = profile_cache.get(session["user_id"])
     except Exception as e:
         app.logger.error(f"Error fetching preferences: {str(e)}")
         app.logger.error(traceback.format_exc())
         flash("An error occurred while loading your preferences.", "danger")
-        preferences_data = []
-
-    return render_template("preferences.html",
-                         preferences=preferences_data[0] if preferences_data else None)
-@app.route("/toggle_meal_item", methods=["POST"])
-@login_required
-def toggle_meal_item():
+        preferences_data = None
+
+    return render_template("preferences.html", preferences=preferences_data)
+PLAN_COMPLETIONS_SQL = """
+    SELECT item_key, completed FROM plan_item_completions
+    WHERE plan_type = ? AND plan_id = ?
+"""
+def plan_completions(plan_type, plan_id):
+    """Completed flags for one plan, keyed by item_key."""
+    rows = db.execute(PLAN_COMPLETIONS_SQL, plan_type, plan_id)
+    return {row["item_key"]: bool(row["completed"]) for row in rows}
+
+
+def set_plan_items(plan_type, plan_id, user_id, item_keys, completed=None):
+    """Set items of a user's plan to `completed`, or flip them when it is None.
+
+    Every item is written by one upsert in one transaction, so concurrent
+    clicks cannot lose each other's updates. Returns the new flags keyed by
+    item_key, or None when the plan does not belong to the user.
+    """
+    table = PLAN_TABLES[plan_type]
+    keys = list(dict.fromkeys(str(key) for key in item_keys))
+    if completed is None:
+        value, on_conflict = 1, "1 - completed"
+    else:
+        value, on_conflict = int(bool(completed)), "excluded.completed"
+    with db.transaction():
+        if not db.execute(f"SELECT id FROM {table} WHERE id = ? AND user_id = ?", plan_id, user_id):
+            return None
+        # WHERE true keeps SQLite from reading ON CONFLICT as a join constraint
+        db.execute(f"""
+            INSERT INTO plan_item_completions (plan_type, plan_id, item_key, completed)
+            SELECT ?, ?, value, ? FROM json_each(?) WHERE true
+            ON CONFLICT(plan_type, plan_id, item_key) DO UPDATE SET
+                completed = {on_conflict},
+                updated_at = CURRENT_TIMESTAMP
+        """, plan_type, plan_id, value, json.dumps(keys))
+        rows = db.execute(PLAN_COMPLETIONS_SQL + " AND item_key IN (?)", plan_type, plan_id, keys)
+        db.execute(f"UPDATE {table} SET version = version + 1 WHERE id = ?", plan_id)
+    return {row["item_key"]: bool(row["completed"]) for row in rows}
+
+
+def toggle_item_response(plan_type, label):
     try:
         data = request.json
         plan_id = data.get("plan_id")
@@ -856,61 +1090,83 @@ def toggle_meal_item():
         if not plan_id or not item_key:
             return jsonify({"success": False, "error": "Missing plan_id or item_key"})
 
-        plan = db.execute("""
-            SELECT * FROM weekly_diet_plans WHERE id = ? AND user_id = ?
-        """, plan_id, session["user_id"])
-
-        if plan:
-            completed_items = json.loads(plan[0]["completed_items"] or "{}")
-            completed_items[item_key] = not completed_items.get(item_key, False)
-
-            db.execute("""
-                UPDATE weekly_diet_plans
-                SET completed_items = ?
-                WHERE id = ? AND user_id = ?
-            """, json.dumps(completed_items), plan_id, session["user_id"])
-
-            return jsonify({"success": True, "completed": completed_items[item_key]})
-
-        return jsonify({"success": False, "error": "Plan not found"})
+        items = set_plan_items(plan_type, plan_id, session["user_id"], [item_key])
+        if items is None:
+            return jsonify({"success": False, "error": "Plan not found"})
+        return jsonify({"success": True, "completed": items[str(item_key)]})
     except Exception as e:
-        app.logger.error(f"Error toggling meal item: {str(e)}")
+        app.logger.error(f"Error toggling {label}: {str(e)}")
         return jsonify({"success": False, "error": "Internal server error"})
 
 
-@app.route("/toggle_shopping_item", methods=["POST"])
+@app.route("/toggle_meal_item", methods=["POST"])
 @login_required
-def toggle_shopping_item():
-    try:
-        data = request.json
-        plan_id = data.get("plan_id")
-        item_key = data.get("item_key")
-
-        if not plan_id or not item_key:
-            return jsonify({"success": False, "error": "Missing plan_id or item_key"})
-
-        plan = db.execute("""
-            SELECT * FROM weekly_diet_plans WHERE id = ? AND user_id = ?
-        """, plan_id, session["user_id"])
+def toggle_meal_item():
+    return toggle_item_response("meal", "meal item")
 
-        if plan:
-            completed_items = json.loads(plan[0]["completed_items"] or "{}")
-            completed_items[item_key] = not completed_items.get(item_key, False)
 
-            db.execute("""
-                UPDATE weekly_diet_plans
-                SET completed_items = ?
-                WHERE id = ? AND user_id = ?
-            """, json.dumps(completed_items), plan_id, session["user_id"])
+@app.route("/toggle_shopping_item", methods=["POST"])
+@login_required
+def toggle_shopping_item():
+    return toggle_item_response("meal", "shopping item")
 
-            return jsonify({"success": True, "completed": completed_items[item_key]})
 
-        return jsonify({"success": False, "error": "Plan not found"})
+@app.route("/plan_items/batch", methods=["POST"])
+@login_required
+def batch_plan_items():
+    # e.g. "mark whole day done": {"plan_type": "meal", "plan_id": 1, "item_keys": [...], "completed": true}
+    try:
+        data = request.json or {}
+        plan_type = data.get("plan_type")
+        plan_id = data.get("plan_id")
+        item_keys = data.get("item_keys")
+        completed = data.get("completed")
+
+        if plan_type not in PLAN_TABLES:
+            return jsonify({"success": False, "error": "Unknown plan type"})
+        if not plan_id or not isinstance(item_keys, list) or not item_keys:
+            return jsonify({"success": False, "error": "Missing plan_id or item_keys"})
+        if completed is not None and not isinstance(completed, bool):
+            return jsonify({"success": False, "error": "completed must be true, false or omitted"})
+
+        items = set_plan_items(plan_type, plan_id, session["user_id"], item_keys, completed)
+        if items is None:
+            return jsonify({"success": False, "error": "Plan not found"})
+        return jsonify({"success": True, "items": items})
     except Exception as e:
-        app.logger.error(f"Error toggling shopping item: {str(e)}")
+        app.logger.error(f"Error updating plan items: {str(e)}")
         return jsonify({"success": False, "error": "Internal server error"})
 
 
+CONNECTION_STATUS_SQL = "SELECT status FROM user_connections WHERE user_id = ? AND friend_id = ?"
+PENDING_REQUEST_SQL = """
+    SELECT 1 FROM user_connections
+    WHERE user_id = ? AND friend_id = ? AND status = 'pending'
+"""
+PENDING_REQUESTS_SQL = """
+    SELECT u.username, uc.user_id, uc.created_at
+    FROM user_connections uc
+    JOIN users u ON uc.user_id = u.id
+    WHERE uc.friend_id = ? AND uc.status = 'pending'
+    ORDER BY uc.created_at DESC
+"""
+# Accepted friends in either direction: (user_id, user_id)
+FRIENDS_SQL = """
+    SELECT u.id, u.username
+    FROM user_connections uc
+    JOIN users u ON uc.friend_id = u.id
+    WHERE uc.user_id = ? AND uc.status = 'accepted'
+    UNION
+    SELECT u.id, u.username
+    FROM user_connections uc
+    JOIN users u ON uc.user_id = u.id
+    WHERE uc.friend_id = ? AND uc.status = 'accepted'
+"""
+FRIEND_IDS_SQL = """
+    SELECT friend_id AS id FROM user_connections WHERE user_id = ? AND status = 'accepted'
+    UNION
+    SELECT user_id AS id FROM user_connections WHERE friend_id = ? AND status = 'accepted'
+"""
 # Send a friend request
 @app.route("/send_friend_request", methods=["POST"])
 @login_required
@@ -932,10 +1188,7 @@ def send_friend_request():
         return jsonify({"success": False, "error": "Cannot send friend request to yourself"}), 400
 
     # Check if request already exists
-    existing = db.execute(
-        "SELECT status FROM user_connections WHERE user_id = ? AND friend_id = ?",
-        user_id, friend_id
-    )
+    existing = db.execute(CONNECTION_STATUS_SQL, user_id, friend_id)
 
     if existing:
         status = existing[0]["status"]
@@ -961,13 +1214,7 @@ def send_friend_request():
 @login_required
 def get_friend_requests():
     user_id = session["user_id"]
-    pending_requests = db.execute("""
-        SELECT u.username, uc.user_id, uc.created_at
-        FROM user_connections uc
-        JOIN users u ON uc.user_id = u.id
-        WHERE uc.friend_id = ? AND uc.status = 'pending'
-        ORDER BY uc.created_at DESC
-    """, user_id)
+    pending_requests = db.execute(PENDING_REQUESTS_SQL, user_id)
     return jsonify({"requests": pending_requests})
 
 @app.route("/handle_friend_request", methods=["POST"])
@@ -982,10 +1229,7 @@ def handle_friend_request():
         return jsonify({"success": False, "error": "Invalid request parameters"}), 400
 
     # Verify request exists and is pending
-    request_exists = db.execute("""
-        SELECT 1 FROM user_connections
-        WHERE user_id = ? AND friend_id = ? AND status = 'pending'
-    """, sender_id, user_id)
+    request_exists = db.execute(PENDING_REQUEST_SQL, sender_id, user_id)
 
     if not request_exists:
         return jsonify({"success": False, "error": "Friend request not found"}), 404
@@ -1005,75 +1249,167 @@ def handle_friend_request():
 
 #TODO: test this function
 
+CHART_MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS", 200))
+def chart_query_params():
+    """Read ?start=YYYY-MM-DD&end=YYYY-MM-DD&points=N, ignoring malformed values."""
+    def parse_date(value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') if value else None
+        except ValueError:
+            return None
+    points = request.args.get("points", CHART_MAX_POINTS, type=int)
+    points = max(3, min(points, CHART_MAX_POINTS * 5))
+    return parse_date(request.args.get("start")), parse_date(request.args.get("end")), points
+# Every participant's record count and newest record, straight from the rollup
+CHART_FRESHNESS_SQL = """
+    SELECT user_id, SUM(record_count) AS records, MAX(last_at) AS last_at
+    FROM bmi_daily_rollup
+    WHERE user_id IN (?)
+    GROUP BY user_id
+    ORDER BY user_id
+"""
+def build_progress_chart_data(user_id, start=None, end=None, points=CHART_MAX_POINTS):
+    user_username = db.execute("SELECT username FROM users WHERE id = ?", user_id)[0]["username"]
+
+    # Get accepted friends list
+    friend_ids = db.execute(FRIENDS_SQL, user_id, user_id)
+    friends = [{"id": friend["id"], "username": friend["username"]} for friend in friend_ids]
+
+    # One query for the user's and all friends' series
+    series = get_bmi_chart_data_bulk([user_id] + [friend["id"] for friend in friends], start, end)
+    # Bound the payload regardless of how long the history is
+    all_chart_data = {user_username: downsample_series(series[user_id], points)}
+    for friend in friends:
+        all_chart_data[friend["username"]] = downsample_series(series[friend["id"]], points)
+
+    # Normalize data to the same length
+    pad_chart_data(all_chart_data)
+
+    return all_chart_data, user_username, friends
 # Progress page: show user's and all accepted friends' progress charts
 @app.route("/progress", methods=["GET"])
 @login_required
 def progress():
     user_id = session["user_id"]
 
-    # Get main user data and username
-    user_chart_data = get_bmi_chart_data(user_id)
-    user_username = db.execute("SELECT username FROM users WHERE id = ?", user_id)[0]["username"]
-
-    # Initialize combined chart data with user's data
-    all_chart_data = {
-        user_username: user_chart_data
-    }
-
-    # Get accepted friends list
-    friend_ids = db.execute("""
-        SELECT u.id, u.username
-        FROM user_connections uc
-        JOIN users u ON uc.friend_id = u.id
-        WHERE uc.user_id = ? AND uc.status = 'accepted'
-        UNION
-        SELECT u.id, u.username
-        FROM user_connections uc
-        JOIN users u ON uc.user_id = u.id
-        WHERE uc.friend_id = ? AND uc.status = 'accepted'
-    """, user_id, user_id)
-
-    # Get all friends' chart data
-    friends = []
-    for friend in friend_ids:
-        friend_id = friend["id"]
-        friend_username = friend["username"]
-        friends.append({"id": friend_id, "username": friend_username})
-        friend_data = get_bmi_chart_data(friend_id)
-        all_chart_data[friend_username] = friend_data
-
-    # Normalize data to the same length
-    max_len = 0
-    for data in all_chart_data.values():
-        if len(data["dates"]) > max_len:
-            max_len = len(data["dates"])
-
-    for username, data in all_chart_data.items():
-        current_len = len(data["dates"])
-        if current_len < max_len:
-            if current_len > 0:
-                last_date = datetime.strptime(data["dates"][-1], '%m/%d')
-                last_bmi = data["bmi_values"][-1]
-                last_weight = data["weights"][-1]
-                last_height = data["heights"][-1]
-            else:
-                # If user has no data, use default values
-                last_date = datetime.now()
-                last_bmi = 0
-                last_weight = 0
-                last_height = 0
-
-            for i in range(max_len - current_len):
-                new_date = last_date + timedelta(days=i+1)
-                data["dates"].append(new_date.strftime('%m/%d'))
-                data["bmi_values"].append(last_bmi)
-                data["weights"].append(last_weight)
-                data["heights"].append(last_height)
+    start, end, points = chart_query_params()
+    all_chart_data, user_username, friends = build_progress_chart_data(user_id, start, end, points)
 
     return render_template("progress.html",
                            all_chart_data=all_chart_data,
+                           summary=bmi_summary(db, user_id, start, end),
                            user_username=user_username,
                            friends=friends)
+# --- JSON API (v1) ---
+def conditional_json(etag, build):
+    """Answer If-None-Match with 304 before calling `build`; otherwise JSON with a strong ETag."""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        # Not jsonify: it sorts keys, and plan days must stay in week order
+        response = app.response_class(app.json.dumps(build(), sort_keys=False), mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+# Format both with a PLAN_TABLES table
+CURRENT_PLAN_VERSION_SQL = """
+    SELECT id, version FROM {table}
+    WHERE user_id = ? AND week_start_date >= date('now', '-7 days')
+    ORDER BY created_at DESC LIMIT 1
+"""
+PLAN_WITH_BLOB_SQL = """
+    SELECT p.id, p.week_start_date, p.created_at, b.data FROM {table} p
+    JOIN plan_blobs b ON b.hash = p.plan_hash
+    WHERE p.id = ? AND p.user_id = ?
+"""
+@app.route("/api/v1/plans/<kind>")
+@login_required
+def api_current_plan(kind):
+    table = PLAN_TABLES.get(kind)
+    if table is None:
+        return jsonify({"error": "Unknown plan type"}), 404
+    # Validator first: id and version only, without the plan blob
+    current = db.execute(CURRENT_PLAN_VERSION_SQL.format(table=table), session["user_id"])
+    if not current:
+        return jsonify({"error": "No plan for this week"}), 404
+    plan_id, version = current[0]["id"], current[0]["version"]
+
+    def build():
+        row = db.execute(PLAN_WITH_BLOB_SQL.format(table=table), plan_id, session["user_id"])[0]
+        return {
+            "plan_id": row["id"],
+            "version": version,
+            "week_start_date": row["week_start_date"],
+            "created_at": row["created_at"],
+            "plan": decode_plan(row["data"]),
+            "completed_items": plan_completions(kind, row["id"]),
+        }
+    return conditional_json(f"{kind}-{plan_id}-{version}", build)
+
+@app.route("/api/v1/plans/<kind>/regenerate", methods=["POST"])
+@login_required
+@rate_limited("plan", ai=True)
+def api_regenerate_plan_slice(kind):
+    # {"plan_id": 1, "day": "Monday", "meal": "lunch"}; omit meal for the whole day
+    table = PLAN_TABLES.get(kind)
+    if table is None:
+        return jsonify({"error": "Unknown plan type"}), 404
+    data = request.get_json(silent=True) or {}
+    day, meal, plan_id = data.get("day"), data.get("meal"), data.get("plan_id")
+    if day not in DAY_NAMES:
+        return jsonify({"error": "day must be a weekday name"}), 400
+    if meal is not None and (kind != "meal" or meal not in SLICE_MEALS):
+        return jsonify({"error": f"meal must be one of {', '.join(SLICE_MEALS)} on meal plans"}), 400
+    if plan_id is None:
+        current = db.execute(f"""
+            SELECT id FROM {table}
+            WHERE user_id = ? AND week_start_date >= date('now', '-7 days')
+            ORDER BY created_at DESC LIMIT 1
+        """, session["user_id"])
+    else:
+        current = db.execute(f"SELECT id FROM {table} WHERE id = ? AND user_id = ?", plan_id, session["user_id"])
+    if not current:
+        return jsonify({"error": "Plan not found"}), 404
+    plan_id = current[0]["id"]
+
+    job_kind = "diet_slice" if kind == "meal" else "workout_slice"
+    try:
+        job_id = plan_jobs.enqueue(job_kind, session["user_id"],
+                                   dedupe_key=f"{job_kind}:{session['user_id']}:{plan_id}:{day}:{meal or ''}",
+                                   plan_type=kind, plan_id=plan_id, day=day, meal=meal, charge_quota=True)
+    except Exception as e:
+        app.logger.error(f"AI {kind} plan slice enqueue error: {e}")
+        return jsonify({"error": f"Failed to queue {kind} plan update"}), 500
+    return jsonify({"job_id": job_id, "status": "queued",
+                    "status_url": url_for("plan_job_status", job_id=job_id)}), 202
+@app.route("/api/v1/progress/chart")
+@login_required
+def api_progress_chart():
+    user_id = session["user_id"]
+    start, end, points = chart_query_params()
+    friend_ids = db.execute(FRIEND_IDS_SQL, user_id, user_id)
+    participants = [user_id] + sorted(friend["id"] for friend in friend_ids)
+    freshness = db.execute(CHART_FRESHNESS_SQL, participants)
+    fingerprint = json.dumps([participants, freshness, start, end, points], default=str)
+    etag = "chart-" + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:32]
+
+    def build():
+        all_chart_data, user_username, friends = build_progress_chart_data(user_id, start, end, points)
+        return {
+            "user": user_username,
+            "friends": friends,
+            "series": all_chart_data,
+            "summary": bmi_summary(db, user_id, start, end),
+            "start": start,
+            "end": end,
+            "points": points
+        }
+    return conditional_json(etag, build)
+@app.route("/api/v1/cache_stats")
+@login_required
+def api_cache_stats():
+    # Per worker process; counts since it started
+    return jsonify({"profile": profile_cache.stats(), "pid": os.getpid()})
 @app.route("/check_ollama")
 @login_required
 def check_ollama():
@@ -1086,34 +1422,7 @@ def check_ollama():
 @app.route("/toggle_workout_item", methods=["POST"])
 @login_required
 def toggle_workout_item():
-    try:
-        data = request.json
-        plan_id = data.get("plan_id")
-        item_key = data.get("item_key")
-
-        if not plan_id or not item_key:
-            return jsonify({"success": False, "error": "Missing plan_id or item_key"})
-
-        plan = db.execute("""
-            SELECT * FROM weekly_workout_plans WHERE id = ? AND user_id = ?
-        """, plan_id, session["user_id"])
-
-        if plan:
-            completed_items = json.loads(plan[0]["completed_items"] or "{}")
-            completed_items[item_key] = not completed_items.get(item_key, False)
-
-            db.execute("""
-                UPDATE weekly_workout_plans
-                SET completed_items = ?
-                WHERE id = ? AND user_id = ?
-            """, json.dumps(completed_items), plan_id, session["user_id"])
-
-            return jsonify({"success": True, "completed": completed_items[item_key]})
-
-        return jsonify({"success": False, "error": "Plan not found"})
-    except Exception as e:
-        app.logger.error(f"Error toggling workout item: {str(e)}")
-        return jsonify({"success": False, "error": "Internal server error"})
+    return toggle_item_response("workout", "workout item")
 
 
 @app.route('/favicon.ico')
@@ -1124,6 +1433,142 @@ def favicon():
        mimetype='image/vnd.microsoft.icon'
    )
 
+# Per-user queries that must be served from an index, checked by `flask check-query-plans`
+# and the test suite; (sql, *sample parameters), with the SQL shared with its call site
+HOT_QUERIES = [
+    (CALCULATOR_HISTORY_SQL, 1, CALCULATOR_HISTORY_LIMIT),
+    (LATEST_BMI_SQL, 1),
+    (LATEST_PREFERENCES_SQL, 1),
+    (LATEST_PREFERENCES_ID_SQL, 1),
+    (CHART_SERIES_SQL, [1, 2, 3], None, None),
+    (CHART_FRESHNESS_SQL, [1, 2, 3]),
+    (SUMMARY_TOTALS_SQL, 1, None, None),
+    (SUMMARY_FIRST_SQL, 1, None, None),
+    (SUMMARY_LAST_SQL, 1, None, None),
+    (CHAT_PAGE_SQL, 1, CHAT_PAGE_SIZE + 1),
+    (CHAT_PAGE_BEFORE_SQL, 1, 100, CHAT_PAGE_SIZE + 1),
+    (SUMMARY_SQL, 1),
+    (RECENT_TURNS_SQL, 1, 0, 50),
+    (UNFOLDED_TURNS_SQL, 1, 0, 100, 20),
+    (PLAN_COMPLETIONS_SQL, "meal", 1),
+    (CONNECTION_STATUS_SQL, 1, 2),
+    (PENDING_REQUEST_SQL, 2, 1),
+    (PENDING_REQUESTS_SQL, 1),
+    (FRIENDS_SQL, 1, 1),
+    (FRIEND_IDS_SQL, 1, 1),
+    *[(sql.format(table=table), *args)
+      for table in PLAN_TABLES.values()
+      for sql, *args in [
+          (CURRENT_PLAN_SQL, 1),
+          (CURRENT_PLAN_VERSION_SQL, 1),
+          (PLAN_WITH_BLOB_SQL, 1, 1),
+          (EXISTING_PLAN_SQL, 1, "2026-01-05"),
+      ]],
+]
+def full_scans(sql, *args):
+    # "SCAN t" is a full table scan; "SCAN t USING INDEX" / "SEARCH" are fine
+    return [line for line in db.query_plan(sql, *args)
+            if line.startswith("SCAN") and "USING" not in line]
+
+@app.cli.command("check-query-plans")
+def check_query_plans():
+    """Fail if any hot per-user query falls back to a full table scan."""
+    failures = 0
+    for sql, *args in HOT_QUERIES:
+        scans = full_scans(sql, *args)
+        if scans:
+            failures += 1
+            print(f"FULL SCAN: {' '.join(sql.split())}\n    {scans}")
+    print(f"{len(HOT_QUERIES) - failures}/{len(HOT_QUERIES)} hot queries use an index")
+    if failures:
+        raise SystemExit(1)
+
+@app.cli.command("rebuild-bmi-rollup")
+@click.option("--user-id", type=int, default=None, help="Only rebuild this user's rollup.")
+def rebuild_bmi_rollup(user_id):
+    """Recompute bmi_daily_rollup from bmi_records."""
+    with db.transaction():
+        rebuild_rollups(db, user_id)
+    days = db.execute("SELECT COUNT(*) AS n FROM bmi_daily_rollup")[0]["n"]
+    print(f"Rebuilt BMI rollup ({days} user-days)")
+
+@app.cli.command("import-bmi")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user-id", type=int, required=True, help="User the records belong to.")
+@click.option("--chunk-size", type=int, default=BMI_IMPORT_CHUNK_SIZE, show_default=True,
+              help="Rows per insert transaction.")
+def import_bmi_command(path, user_id, chunk_size):
+    """Import BMI history from a CSV, JSON or JSON Lines file."""
+    if not db.execute("SELECT id FROM users WHERE id = ?", user_id):
+        raise click.BadParameter(f"No user with id {user_id}", param_hint="--user-id")
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        counts = import_bmi_records(db, user_id, read_rows(f, detect_format(path)),
+                                    measure_many, chunk_size)
+    print(f"Imported {counts['imported']} records in {time.perf_counter() - started:.1f}s "
+          f"({counts['duplicates']} duplicates, {counts['skipped']} invalid rows skipped)")
+
+@app.cli.command("pregenerate-plans")
+@click.option("--kind", type=click.Choice(["diet", "workout", "all"]), default="all", show_default=True)
+@click.option("--week", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Any day of the target week; defaults to the current week.")
+@click.option("--concurrency", type=int, default=2, show_default=True, help="Plans generated at once.")
+@click.option("--active-weeks", type=int, default=4, show_default=True,
+              help="Only users with a plan of that kind in this many past weeks; 0 for every user.")
+@click.option("--max-attempts", type=int, default=3, show_default=True, help="Tries per user and week.")
+@click.option("--limit", type=int, default=None, help="Stop after starting this many plans.")
+@click.option("--max-minutes", type=float, default=None, help="Stop starting new plans after this long.")
+def pregenerate_plans_command(kind, week, concurrency, active_weeks, max_attempts, limit, max_minutes):
+    """Generate this week's plans for users who have none yet; safe to re-run, resumes from checkpoints."""
+    week = plan_week_start(week.date() if week else None)
+    pregenerator = PlanPregenerator(db, app, {"diet": generate_weekly_diet_plan_ai,
+                                              "workout": generate_weekly_workout_plan_ai},
+                                    concurrency=concurrency, max_attempts=max_attempts)
+    started = time.perf_counter()
+    counts = pregenerator.run(week, ("diet", "workout") if kind == "all" else (kind,), limit=limit,
+                              active_weeks=active_weeks,
+                              max_seconds=max_minutes * 60 if max_minutes is not None else None)
+    print(f"Week of {week}: {counts['done']} plans ready, {counts['skipped']} users without a profile, "
+          f"{counts['failed']} failed in {time.perf_counter() - started:.1f}s")
+
+@app.cli.command("archive-plans")
+@click.option("--weeks", type=int, default=12, show_default=True,
+              help="Keep plans whose week started within this many weeks.")
+@click.option("--drop", is_flag=True, help="Delete old plans instead of moving them to plan_archive.")
+@click.option("--vacuum", is_flag=True, help="Rewrite the database file afterwards to return freed space.")
+def archive_plans_command(weeks, drop, vacuum):
+    """Move (or delete) old weekly plans out of the live plan tables and prune unused blobs."""
+    before = plan_week_start() - timedelta(weeks=weeks)
+    moved, pruned = archive_plans(db, before.isoformat(), drop=drop)
+    if vacuum:
+        db.execute("VACUUM")
+    print(f"{'Deleted' if drop else 'Archived'} {moved} plans from before {before}; pruned {pruned} unused plan blobs")
+
+@app.cli.command("backfill-chat-html")
+def backfill_chat_html():
+    """Render message_html/response_html for chat rows stored before those columns existed."""
+    total = 0
+    last_id = 0
+    while True:
+        rows = db.execute("""
+            SELECT id, message, response FROM chat_messages
+            WHERE id > ? AND (message_html IS NULL OR response_html IS NULL)
+            ORDER BY id
+            LIMIT 1000
+        """, last_id)
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        with db.transaction():
+            for row in rows:
+                db.execute(
+                    "UPDATE chat_messages SET message_html = ?, response_html = ? WHERE id = ?",
+                    clean_ai_response(row["message"]), clean_ai_response(row["response"]), row["id"]
+                )
+        total += len(rows)
+        print(f"Backfilled {total} chat messages")
+    print(f"Done, {total} chat messages backfilled")
+
 # Error Handlers
 @app.errorhandler(404)
 def page_not_found(e):
@@ -1134,14 +1579,21 @@ def forbidden(e):
 @app.errorhandler(500)
 def internal_server_error(e):
     return "<h1>500 - Internal Server Error</h1><p>Something went wrong on our end. Please try again later.</p>", 500
+# Background plan generation
+plan_jobs = JobQueue(db, app, max_workers=int(os.environ.get("PLAN_JOB_WORKERS", 2)))
+plan_jobs.register("diet", generate_weekly_diet_plan_ai)
+plan_jobs.register("workout", generate_weekly_workout_plan_ai)
+plan_jobs.register("diet_slice", regenerate_plan_slice)
+plan_jobs.register("workout_slice", regenerate_plan_slice)
+chat_memory = ChatHistory(db, app, ai_call, token_budget=int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 1200)))
+
 # Initialize database and ensure schema is up to date
 with app.app_context():
     init_db()
+    plan_jobs.start()
     # Ensure the updated_at column exists for existing databases
     #
 if __name__ == "__main__":
-    init_db()
-
     # Check Ollama service before starting the app
     is_running, message = check_ollama_service()
     if not is_running:
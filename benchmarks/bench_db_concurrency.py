@@ -0,0 +1,112 @@
+"""Reads during a long write transaction: rollback journal vs WAL.
+
+A writer repeatedly holds a write transaction open (BEGIN IMMEDIATE, a
+large insert, a pause, COMMIT), as a BMI import or a migration does.
+Readers on their own connections time a per-user lookup and count how
+many reads were blocked by the writer or gave up after READ_TIMEOUT.
+Raw sqlite3 connections are used so lock waits are not hidden behind
+cs50's statement parsing.
+
+Run from the project root:  python benchmarks/bench_db_concurrency.py
+"""
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SQLITE_PRAGMAS  # noqa: E402
+
+READERS = 4
+DURATION = 5.0
+WRITE_ROWS = 200000  # large enough to spill the writer's page cache
+HOLD = 0.5  # seconds the writer keeps its transaction open after writing
+READ_TIMEOUT = 0.25  # busy timeout for readers, in seconds
+BLOCKED = 0.05  # a read slower than this waited for the writer
+
+
+def connect(path, pragmas, timeout):
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    for name, value in pragmas.items():
+        if name not in ("journal_mode", "busy_timeout"):
+            connection.execute(f"PRAGMA {name}={value}")
+    return connection
+
+
+def run(label, pragmas):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    setup = connect(path, pragmas, 5)
+    setup.execute(f"PRAGMA journal_mode={pragmas['journal_mode']}")
+    setup.execute("CREATE TABLE bmi_records (id INTEGER PRIMARY KEY, user_id INTEGER, bmi REAL)")
+    setup.execute("CREATE INDEX idx_bmi_user ON bmi_records (user_id, id)")
+    setup.executemany("INSERT INTO bmi_records (user_id, bmi) VALUES (?, ?)", [(u, 22.0) for u in range(100)])
+    setup.close()
+
+    stop = time.monotonic() + DURATION
+    latencies, timeouts, commits = [], [0], [0]
+    lock = threading.Lock()
+
+    def writer():
+        # A small page cache makes the large insert spill to the file mid-transaction,
+        # which in rollback-journal mode takes the exclusive lock before COMMIT
+        connection = connect(path, {**pragmas, "cache_size": 200}, 5)
+        while time.monotonic() < stop:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("""
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                INSERT INTO bmi_records (user_id, bmi) SELECT 1000 + i % 1000, 23.0 FROM n
+            """, (WRITE_ROWS,))
+            time.sleep(HOLD)
+            connection.execute("COMMIT")
+            connection.execute("DELETE FROM bmi_records WHERE user_id >= 1000")
+            commits[0] += 1
+            time.sleep(0.05)
+        connection.close()
+
+    def reader(user_id):
+        connection = connect(path, pragmas, READ_TIMEOUT)
+        local, failed = [], 0
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                connection.execute(
+                    "SELECT bmi FROM bmi_records WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                failed += 1
+                continue
+            finally:
+                local.append(time.perf_counter() - started)
+            time.sleep(0.001)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            timeouts[0] += failed
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader, args=(n,)) for n in range(READERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    latencies.sort()
+    ms = [x * 1000 for x in latencies]
+    blocked = sum(1 for x in latencies if x >= BLOCKED)
+    print(f"{label:<18} commits={commits[0]:>3}  reads={len(ms):>6}  blocked={blocked:>5} "
+          f"({blocked / len(ms):6.1%})  timed out={timeouts[0]:>5}  "
+          f"p50={statistics.median(ms):7.2f}ms  p99={ms[int(len(ms) * 0.99) - 1]:7.2f}ms  max={ms[-1]:7.2f}ms")
+
+
+if __name__ == "__main__":
+    print(f"{READERS} readers, writer holds {WRITE_ROWS} inserted rows for {HOLD}s per transaction, "
+          f"read timeout {READ_TIMEOUT}s, blocked = slower than {BLOCKED * 1000:.0f}ms")
+    run("rollback journal", {**SQLITE_PRAGMAS, "journal_mode": "DELETE", "synchronous": "FULL"})
+    run("WAL", SQLITE_PRAGMAS)
@@ -0,0 +1,113 @@
+"""Progress chart data: the baseline per-participant code vs one bulk query.
+
+Seeds 100 friends x 1,000 BMI records in a throwaway database.
+Run from anywhere:  python benchmarks/bench_progress_chart.py
+"""
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRIENDS = 100
+RECORDS = 1000
+
+# app.py opens ./health.db and the prompt files at import time
+workdir = tempfile.mkdtemp()
+for name in ("diet_coach_prompt.txt", "workout_coach_prompt.txt"):
+    shutil.copy(os.path.join(ROOT, name), workdir)
+open(os.path.join(workdir, "health.db"), "w").close()
+os.chdir(workdir)
+sys.path.insert(0, ROOT)
+logging.disable(logging.INFO)
+
+import app  # noqa: E402
+
+
+def seed():
+    connection = sqlite3.connect("health.db")
+    users = FRIENDS + 1
+    connection.executemany(
+        "INSERT INTO users (id, username, password) VALUES (?, ?, 'x')",
+        [(user_id, f"user{user_id}") for user_id in range(1, users + 1)]
+    )
+    start = datetime(2022, 1, 1)
+    connection.executemany(
+        "INSERT INTO bmi_records (user_id, weight, height, bmi, category, created_at) VALUES (?, ?, 175, ?, 'Normal', ?)",
+        (
+            (user_id, 70 + (day % 7), 22.0 + (day % 5) / 10, (start + timedelta(days=day)).strftime('%Y-%m-%d %H:%M:%S'))
+            for user_id in range(1, users + 1)
+            for day in range(RECORDS - user_id)  # uneven lengths so padding has work to do
+        )
+    )
+    connection.commit()
+    connection.close()
+    return list(range(1, users + 1))
+
+
+def baseline_chart_data(user_ids):
+    # The code this replaced, from the /progress route: one query per participant,
+    # strptime/strftime per row, then padding with a strptime per series
+    all_chart_data = {}
+    for user_id in user_ids:
+        records = app.db.execute("""
+            SELECT bmi, weight, height, created_at FROM bmi_records
+            WHERE user_id = ?
+            ORDER BY created_at ASC
+        """, user_id)
+        chart_data = {"dates": [], "bmi_values": [], "weights": [], "heights": []}
+        for record in records:
+            if isinstance(record["created_at"], str):
+                date_obj = datetime.strptime(record["created_at"], '%Y-%m-%d %H:%M:%S')
+            else:
+                date_obj = record["created_at"]
+            chart_data["dates"].append(date_obj.strftime('%m/%d'))
+            chart_data["bmi_values"].append(record["bmi"])
+            chart_data["weights"].append(record["weight"])
+            chart_data["heights"].append(record["height"])
+        all_chart_data[user_id] = chart_data
+
+    max_len = 0
+    for data in all_chart_data.values():
+        if len(data["dates"]) > max_len:
+            max_len = len(data["dates"])
+    for data in all_chart_data.values():
+        current_len = len(data["dates"])
+        if current_len < max_len:
+            if current_len > 0:
+                last_date = datetime.strptime(data["dates"][-1], '%m/%d')
+                last_bmi = data["bmi_values"][-1]
+                last_weight = data["weights"][-1]
+                last_height = data["heights"][-1]
+            else:
+                last_date = datetime.now()
+                last_bmi = 0
+                last_weight = 0
+                last_height = 0
+            for i in range(max_len - current_len):
+                new_date = last_date + timedelta(days=i+1)
+                data["dates"].append(new_date.strftime('%m/%d'))
+                data["bmi_values"].append(last_bmi)
+                data["weights"].append(last_weight)
+                data["heights"].append(last_height)
+    return all_chart_data
+
+
+def timed(label, fn):
+    started = time.perf_counter()
+    result = fn()
+    print(f"{label:<24} {(time.perf_counter() - started) * 1000:9.1f} ms")
+    return result
+
+
+if __name__ == "__main__":
+    user_ids = seed()
+    old = timed("baseline", lambda: baseline_chart_data(user_ids))
+    new = timed("bulk query + padding", lambda: app.pad_chart_data(app.get_bmi_chart_data_bulk(user_ids)))
+    # Padding never crosses February here, where the baseline's year-1900 dates would differ
+    assert old == new, "bulk chart data differs from the baseline"
+    shutil.rmtree(workdir)
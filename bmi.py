@@ -0,0 +1,89 @@
+"""BMI arithmetic and categories, for single readings and whole arrays.
+
+Category metadata is built once at import; the scalar functions return the
+shared constants and the array functions work on indices into CATEGORIES.
+"""
+from bisect import bisect_right
+
+import numpy as np
+
+UNDERWEIGHT = {
+    "category": "underweight",
+    "name": "Underweight",
+    "color": "#3a86ff",
+    "tip": """<strong>Underweight Advice:</strong><br>
+                    • Increase calorie intake with nutrient-dense foods<br>
+                    • Include protein-rich foods like eggs, chicken, beans<br>
+                    • Consider strength training 3x/week<br>
+                    • 🍳🥩💪""",
+}
+NORMAL = {
+    "category": "normal",
+    "name": "Normal",
+    "color": "#06d6a0",
+    "tip": """<strong>Healthy Weight Tips:</strong><br>
+                    • Maintain balanced diet (fruits, veggies, whole grains)<br>
+                    • 150+ mins exercise weekly<br>
+                    • Stay hydrated (8 glasses/day)<br>
+                    • 🥗🏃‍♂️💧""",
+}
+OVERWEIGHT = {
+    "category": "overweight",
+    "name": "Overweight",
+    "color": "#ffd166",
+    "tip": """<strong>Overweight Advice:</strong><br>
+                    • Aim for 1-2 lbs weight loss/week<br>
+                    • Increase physical activity (walking, cycling)<br>
+                    • Reduce sugary drinks and snacks<br>
+                    • 🚶‍♀️🚫🍰""",
+}
+OBESE = {
+    "category": "obese",
+    "name": "Obese",
+    "color": "#ef476f",
+    "tip": """<strong>Obesity Advice:</strong><br>
+                    • Consult healthcare professional<br>
+                    • Focus on sustainable lifestyle changes<br>
+                    • Join support groups for motivation<br>
+                    • 👨‍⚕️🤝💚""",
+}
+
+CATEGORIES = (UNDERWEIGHT, NORMAL, OVERWEIGHT, OBESE)
+# Lower bound of every category after the first; a BMI on a bound belongs to the higher one
+THRESHOLDS = (18.5, 24.9, 29.9)
+CATEGORY_NAMES = np.array([category["name"] for category in CATEGORIES], dtype=object)
+
+_THRESHOLDS = np.array(THRESHOLDS)
+
+
+def calculate_bmi(weight, height):
+    """BMI from weight in kg and height in cm, rounded to one decimal."""
+    # Same arithmetic and rounding as the bulk path, so both store identical values
+    return float(calculate_bmi_many(weight, height))
+
+
+def get_bmi_category(bmi):
+    """Category metadata for one BMI value (a shared constant; do not mutate)."""
+    return CATEGORIES[bisect_right(THRESHOLDS, bmi)]
+
+
+def calculate_bmi_many(weights, heights):
+    """Vectorized calculate_bmi over equal-length sequences of kg and cm."""
+    heights_m = np.asarray(heights, dtype=np.float64) / 100
+    return np.round(np.asarray(weights, dtype=np.float64) / (heights_m * heights_m), 1)
+
+
+def category_indices(bmis):
+    """Index into CATEGORIES for every BMI value."""
+    return np.digitize(np.asarray(bmis, dtype=np.float64), _THRESHOLDS)
+
+
+def categorize_many(bmis):
+    """Category names for every BMI value, as an object array."""
+    return CATEGORY_NAMES[category_indices(bmis)]
+
+
+def measure_many(weights, heights):
+    """BMI values and category names as Python lists, ready to bind to SQL."""
+    bmis = calculate_bmi_many(weights, heights)
+    return bmis.tolist(), categorize_many(bmis).tolist()
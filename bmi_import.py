@@ -0,0 +1,142 @@
+"""Bulk import of BMI history exported from smart scales and other apps.
+
+Rows are streamed from CSV, JSON Lines or a JSON array, measured a chunk at a
+time and written with one executemany per chunk, each chunk in its own
+transaction, so memory stays bounded by the chunk size.
+"""
+import csv
+import io
+import json
+import logging
+from datetime import datetime, timezone
+from itertools import islice
+
+from rollups import merge_records
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+FORMATS = {".csv": "csv", ".json": "json", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+# Accepted column names, first match wins; weight in kg, height in cm
+WEIGHT_FIELDS = ("weight", "weight_kg")
+HEIGHT_FIELDS = ("height", "height_cm")
+TIMESTAMP_FIELDS = ("created_at", "timestamp", "date", "datetime")
+
+INSERT_SQL = """
+    INSERT INTO bmi_records (created_at, weight, height, bmi, category, user_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def detect_format(filename):
+    for suffix, fmt in FORMATS.items():
+        if filename.lower().endswith(suffix):
+            return fmt
+    raise ValueError("Unsupported file type; use .csv, .json, .jsonl or .ndjson")
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per row from a binary stream, with lower-cased keys."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        reader.fieldnames = [normalize_key(name) for name in reader.fieldnames or []]
+        yield from reader
+    elif fmt == "jsonl":
+        for line in text:
+            if line.strip():
+                yield normalize_keys(json.loads(line))
+    elif fmt == "json":
+        # A JSON array has to be parsed whole; prefer JSON Lines for large histories
+        rows = json.load(text)
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of records")
+        yield from map(normalize_keys, rows)
+    else:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+
+def normalize_key(name):
+    return str(name).strip().lower()
+
+
+def normalize_keys(row):
+    if not isinstance(row, dict):
+        return row
+    return {normalize_key(key): value for key, value in row.items()}
+
+
+def field(row, names):
+    for name in names:
+        if row.get(name) not in (None, ""):
+            return row[name]
+    return None
+
+
+def parse_timestamp(value):
+    """Normalise to the 'YYYY-MM-DD HH:MM:SS' UTC format of CURRENT_TIMESTAMP."""
+    if isinstance(value, (int, float)):
+        moment = datetime.fromtimestamp(value, timezone.utc)
+    else:
+        value = str(value).strip()
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is None and len(value) == 19:
+            # Already 'YYYY-MM-DD[T ]HH:MM:SS'; formatting a datetime costs more than the parse
+            return f"{value[:10]} {value[11:]}"
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.isoformat(" ", "seconds")
+
+
+def parse_measurement(row):
+    """(created_at, weight, height) for a valid row, otherwise None."""
+    if not isinstance(row, dict):
+        return None
+    try:
+        weight = float(field(row, WEIGHT_FIELDS))
+        height = float(field(row, HEIGHT_FIELDS))
+        created_at = parse_timestamp(field(row, TIMESTAMP_FIELDS))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+    if not (0 < weight < 1000 and 0 < height < 300):
+        return None
+    return created_at, weight, height
+
+
+def import_bmi_records(db, user_id, rows, measure, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Insert parsed rows for one user and fold them into the daily rollup.
+
+    `measure(weights, heights)` returns parallel lists of BMI values and
+    category names for a whole chunk. Returns imported/duplicate/skipped counts.
+    """
+    counts = {"imported": 0, "duplicates": 0, "skipped": 0}
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        measurements = [m for m in map(parse_measurement, chunk) if m is not None]
+        counts["skipped"] += len(chunk) - len(measurements)
+        if not measurements:
+            continue
+        created, weights, heights = zip(*measurements)
+        bmis, categories = measure(weights, heights)
+        with db.transaction():
+            # A timestamp the user already has is a re-import, not a new measurement
+            seen = {row["created_at"] for row in db.execute("""
+                SELECT created_at FROM bmi_records
+                WHERE user_id = ? AND created_at BETWEEN ? AND ?
+            """, user_id, min(created), max(created))}
+            records = []
+            for record in zip(created, weights, heights, bmis, categories):
+                if record[0] not in seen:
+                    seen.add(record[0])
+                    records.append(record)
+            if records:
+                db.executemany(INSERT_SQL, [(*record, user_id) for record in records])
+                merge_records(db, user_id, records)
+        counts["imported"] += len(records)
+        counts["duplicates"] += len(measurements) - len(records)
+    logger.info(f"BMI import for user {user_id}: {counts}")
+    return counts
@@ -0,0 +1,131 @@
+"""Token-budgeted chat history with a rolling per-user summary of older turns.
+
+The request path only reads: the newest turns that fit the budget plus the
+stored summary. Folding turns that fell out of the window into the summary
+is an AI call, so it runs on a background worker.
+"""
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and their AI health coach. "
+    "The history holds the summary so far and the message holds newer turns. "
+    "Reply with only the updated summary, under 120 words: the user's goals, constraints, health details, "
+    "preferences and any advice or commitments worth remembering. No greetings or commentary."
+)
+
+SUMMARY_SQL = "SELECT summary, through_id FROM chat_summaries WHERE user_id = ?"
+# Newest turns not yet folded into the summary: (user_id, through_id, limit)
+RECENT_TURNS_SQL = """
+    SELECT id, message, response FROM chat_messages
+    WHERE user_id = ? AND id > ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+# Oldest turns to fold next: (user_id, through_id, upto_id, limit)
+UNFOLDED_TURNS_SQL = """
+    SELECT id, message, response FROM chat_messages
+    WHERE user_id = ? AND id > ? AND id <= ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English; only used for budgeting
+    return math.ceil(len(text or "") / 4)
+
+
+def format_turn(row):
+    return f"User: {row['message']}\nAI: {row['response']}"
+
+
+class ChatHistory:
+    """Builds the history string sent with every chat message.
+
+    `call(sys_prompt, history, message)` is the AI call used to fold old
+    turns into the summary; like ai_caller.call it returns text starting
+    with "Error:" on failure.
+    """
+
+    def __init__(self, db, app, call, token_budget=1200, max_turns=50, fold_batch=20):
+        self.db = db
+        self.app = app
+        self.call = call
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.fold_batch = fold_batch
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+
+    def summary(self, user_id):
+        """(summary, id of the last folded message) for a user."""
+        rows = self.db.execute(SUMMARY_SQL, user_id)
+        return (rows[0]["summary"], rows[0]["through_id"]) if rows else ("", 0)
+
+    def build(self, user_id):
+        summary, through_id = self.summary(user_id)
+        rows = self.db.execute(RECENT_TURNS_SQL, user_id, through_id, self.max_turns)
+
+        budget = self.token_budget - estimate_tokens(summary)
+        kept = []
+        for row in rows:
+            cost = estimate_tokens(format_turn(row))
+            if cost > budget:
+                break
+            kept.append(row)
+            budget -= cost
+
+        # Once turns fall out of the window (or past max_turns), fold the older
+        # half of the window too, so the next few messages fit without another fold
+        if len(kept) < len(rows) or len(rows) == self.max_turns:
+            self.refresh_async(user_id, kept[len(kept) // 2]["id"] if kept else rows[0]["id"])
+
+        parts = [f"Summary of earlier conversation: {summary}"] if summary else []
+        parts.extend(format_turn(row) for row in reversed(kept))
+        return "\n".join(parts)
+
+    def refresh_async(self, user_id, upto_id):
+        """Fold messages up to `upto_id` into the user's summary in the background."""
+        with self.lock:
+            if user_id in self.pending:
+                return
+            self.pending.add(user_id)
+        self.executor.submit(self._refresh, user_id, upto_id)
+
+    def _refresh(self, user_id, upto_id):
+        try:
+            with self.app.app_context():
+                summary, through_id = self.summary(user_id)
+                while through_id < upto_id:
+                    rows = self.db.execute(UNFOLDED_TURNS_SQL, user_id, through_id, upto_id, self.fold_batch)
+                    if not rows:
+                        break
+                    reply = self.call(
+                        sys_prompt=SUMMARY_PROMPT,
+                        history=summary,
+                        message="\n".join(format_turn(row) for row in rows)
+                    )
+                    if not reply or reply.startswith("Error:"):
+                        logger.warning(f"Chat summary refresh for user {user_id} failed: {reply}")
+                        break
+                    summary, through_id = reply.strip(), rows[-1]["id"]
+                    # Another worker may have folded further already; never move backwards
+                    self.db.execute("""
+                        INSERT INTO chat_summaries (user_id, summary, through_id) VALUES (?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            summary = excluded.summary,
+                            through_id = excluded.through_id,
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE excluded.through_id > chat_summaries.through_id
+                    """, user_id, summary, through_id)
+        except Exception:
+            logger.exception(f"Chat summary refresh for user {user_id} failed")
+        finally:
+            with self.lock:
+                self.pending.discard(user_id)
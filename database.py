@@ -0,0 +1,120 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import cs50
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+# journal_mode is stored in the database file and set once at startup;
+# the rest are applied to every new SQLite connection in the pool
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",      # readers no longer block behind a writer
+    "busy_timeout": 5000,       # wait for a lock instead of failing with "database is locked"
+    "synchronous": "NORMAL",    # safe with WAL, avoids an fsync per commit
+    "cache_size": -20000,       # ~20 MB page cache per connection
+    "temp_store": "MEMORY",
+}
+
+
+class SQL(cs50.SQL):
+    """cs50.SQL with per-thread transaction state and tuned SQLite pragmas.
+
+    cs50 tracks BEGIN/COMMIT in a single ``_autocommit`` attribute shared by
+    every thread, so one thread's transaction changes how all other threads
+    commit. Here that flag is thread-local, matching cs50's thread-local
+    connections.
+    """
+
+    def __init__(self, url, pragmas=None, **kwargs):
+        self._state = threading.local()
+        self._pragmas = dict(SQLITE_PRAGMAS if pragmas is None else pragmas)
+        connect_args = kwargs.pop("connect_args", {})
+        connect_args.setdefault("timeout", self._pragmas.get("busy_timeout", 5000) / 1000)
+        connect_args.setdefault("check_same_thread", False)
+        super().__init__(url, connect_args=connect_args, **kwargs)
+        # cs50 exposes no hook for per-connection setup, so listen on its engine
+        sqlalchemy.event.listen(self._engine, "connect", self._apply_pragmas)
+        # Connections cs50 opened while testing the URL predate the listener
+        self._engine.dispose()
+        journal_mode = self._pragmas.get("journal_mode")
+        if journal_mode and self._engine.dialect.name == "sqlite":
+            with self._engine.connect() as connection:
+                mode = connection.exec_driver_sql(f"PRAGMA journal_mode={journal_mode}").scalar()
+            if str(mode).upper() != str(journal_mode).upper():
+                logger.warning(f"SQLite journal_mode is {mode}, wanted {journal_mode}")
+
+    @property
+    def _autocommit(self):
+        return getattr(self._state, "autocommit", True)
+
+    @_autocommit.setter
+    def _autocommit(self, value):
+        self._state.autocommit = value
+
+    def _apply_pragmas(self, dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in self._pragmas.items():
+            if name != "journal_mode":
+                cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @contextmanager
+    def transaction(self, mode="IMMEDIATE"):
+        """Run the enclosed statements in one short SQLite transaction.
+
+        IMMEDIATE takes the write lock up front, so read-modify-write blocks
+        cannot interleave with another writer.
+        """
+        self.execute(f"BEGIN {mode}")
+        try:
+            yield self
+        except BaseException:
+            try:
+                self.execute("ROLLBACK")
+            except RuntimeError:
+                # cs50 drops the connection on OperationalError, which already rolled back
+                pass
+            raise
+        else:
+            self.execute("COMMIT")
+        finally:
+            # cs50 does not recognise COMMIT/ROLLBACK as ending a transaction,
+            # so restore autocommit and hand the connection back to the pool
+            self._autocommit = True
+            self._disconnect()
+
+    def executemany(self, sql, rows):
+        """Run `sql` once per parameter tuple in `rows`; returns the rows changed.
+
+        cs50's execute() binds one parameter set per call. This goes through
+        the same thread-local connection, so it must run inside transaction().
+        """
+        if self._autocommit:
+            raise RuntimeError("executemany() must be called inside transaction()")
+        name = self._name()
+        if not hasattr(cs50.sql._data, name):
+            setattr(cs50.sql._data, name, self._engine.connect())
+        connection = getattr(cs50.sql._data, name)
+        return connection.exec_driver_sql(sql, list(rows)).rowcount
+
+    def query_plan(self, sql, *args):
+        """Return the EXPLAIN QUERY PLAN detail lines for `sql`.
+
+        Like execute(), a list argument fills its ``?`` with one placeholder per item.
+        """
+        pieces = sql.split("?")
+        if len(pieces) != len(args) + 1:
+            raise ValueError(f"Expected {len(pieces) - 1} parameters, got {len(args)}")
+        sql, params = pieces[0], []
+        for arg, piece in zip(args, pieces[1:]):
+            values = list(arg) if isinstance(arg, (list, tuple)) else [arg]
+            sql += ", ".join("?" * len(values)) + piece
+            params.extend(values)
+        with self._engine.connect() as connection:
+            rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", tuple(params)).fetchall()
+        return [row[-1] for row in rows]
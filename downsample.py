@@ -0,0 +1,44 @@
+def lttb_indices(values, threshold):
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points that keep the series' shape.
+
+    Points are treated as evenly spaced along x. The first and last points are
+    always kept. Returns every index when the series is already small enough.
+    """
+    n = len(values)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        return [0, n - 1][:max(threshold, 0)]
+
+    selected = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        avg_x = (next_start + next_end - 1) / 2
+        avg_y = sum(values[next_start:next_end]) / (next_end - next_start)
+
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        ax, ay = a, values[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (values[j] - ay) - (ax - j) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def downsample_series(data, threshold, key="bmi_values"):
+    """Downsample every parallel list in a chart series dict using LTTB on `key`."""
+    if threshold is None or len(data[key]) <= threshold:
+        return data
+    indices = lttb_indices(data[key], threshold)
+    return {name: [values[i] for i in indices] for name, values in data.items()}
@@ -0,0 +1,142 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobFailed(Exception):
+    """Raised by a handler to fail its job with a short error code for the status endpoint."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class JobQueue:
+    """Runs AI plan generation off the request thread on a bounded worker pool.
+
+    Job state lives in the ``plan_jobs`` table so the frontend can poll it and
+    so a restart does not leave jobs stuck in ``running`` forever. Several
+    worker processes share the table: each stamps its jobs with its own
+    ``owner`` and refreshes their ``updated_at`` every ``heartbeat`` seconds,
+    and only jobs not refreshed for ``stale_after`` seconds are failed.
+    """
+
+    def __init__(self, db, app, max_workers=2, heartbeat=30, stale_after=120):
+        self.db = db
+        self.app = app
+        self.handlers = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plan-job")
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        # Unique per process start, so a recycled pid never looks alive
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    def register(self, kind, handler):
+        # handler(user_id, **options) returns a result, or None when the user profile is incomplete
+        self.handlers[kind] = handler
+
+    def start(self):
+        """Fail abandoned jobs, then keep this worker's jobs alive in the background."""
+        self.recover()
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self._beat, name="plan-job-heartbeat", daemon=True)
+            self.heartbeat_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def recover(self):
+        """Fail in-flight jobs whose worker stopped refreshing them; returns how many."""
+        # Their worker exited or crashed, so they will never finish
+        failed = self.db.execute("""
+            UPDATE plan_jobs
+            SET status = 'failed', error = 'Interrupted by server restart', updated_at = CURRENT_TIMESTAMP
+            WHERE status IN ('queued', 'running')
+              AND (owner IS NULL OR owner != ?)
+              AND updated_at < datetime('now', ?)
+        """, self.owner, f"-{self.stale_after} seconds")
+        if failed:
+            logger.warning(f"Failed {failed} plan jobs abandoned by another worker")
+        return failed
+
+    def touch(self):
+        self.db.execute("""
+            UPDATE plan_jobs SET updated_at = CURRENT_TIMESTAMP
+            WHERE owner = ? AND status IN ('queued', 'running')
+        """, self.owner)
+
+    def _beat(self):
+        while not self.stopped.wait(self.heartbeat):
+            try:
+                self.touch()
+                self.recover()
+            except Exception:
+                logger.exception("Plan job heartbeat failed")
+
+    def enqueue(self, kind, user_id, dedupe_key=None, **options):
+        """Queue a job and return its id.
+
+        While a job with the same `dedupe_key` is queued or running, its id is
+        returned instead, so identical concurrent requests share one run.
+        """
+        if kind not in self.handlers:
+            raise KeyError(f"Unknown job kind: {kind}")
+        for _ in range(3):
+            # The partial unique index on in-flight dedupe keys makes this atomic across workers
+            job_id = self.db.execute("""
+                INSERT INTO plan_jobs (user_id, kind, status, dedupe_key, owner) VALUES (?, ?, 'queued', ?, ?)
+                ON CONFLICT (dedupe_key) WHERE status IN ('queued', 'running') DO NOTHING
+            """, user_id, kind, dedupe_key, self.owner)
+            if job_id is not None:
+                self.executor.submit(self._run, job_id, kind, user_id, options)
+                return job_id
+            rows = self.db.execute("""
+                SELECT id FROM plan_jobs
+                WHERE dedupe_key = ? AND status IN ('queued', 'running')
+            """, dedupe_key)
+            if rows:
+                logger.info(f"Coalesced {kind} request for user {user_id} into job {rows[0]['id']}")
+                return rows[0]["id"]
+            # The in-flight job finished between the two statements; try again
+        raise RuntimeError(f"Could not queue {kind} job for user {user_id}")
+
+    def get(self, job_id, user_id):
+        rows = self.db.execute("""
+            SELECT id, kind, status, error, created_at, updated_at
+            FROM plan_jobs
+            WHERE id = ? AND user_id = ?
+        """, job_id, user_id)
+        return rows[0] if rows else None
+
+    def _set_status(self, job_id, status, error=None):
+        self.db.execute("""
+            UPDATE plan_jobs
+            SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, status, error, job_id)
+
+    def _run(self, job_id, kind, user_id, options):
+        with self.app.app_context():
+            try:
+                self._set_status(job_id, "running")
+                result = self.handlers[kind](user_id, **options)
+                if result is None:
+                    self._set_status(job_id, "failed", "missing_profile")
+                else:
+                    self._set_status(job_id, "done")
+            except JobFailed as e:
+                logger.info(f"Plan job {job_id} ({kind}) failed: {e.code}")
+                self._set_status(job_id, "failed", e.code)
+            except Exception as e:
+                logger.error(f"Plan job {job_id} ({kind}) failed: {e}")
+                try:
+                    self._set_status(job_id, "failed", str(e))
+                except Exception:
+                    logger.exception(f"Could not record failure for plan job {job_id}")
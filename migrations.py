@@ -0,0 +1,336 @@
+import logging
+
+from plan_store import migrate_plan_data
+from rollups import rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+# Ordered schema migrations: (version, name, steps). A step is either a SQL
+# statement or a callable taking the db handle, for data backfills. Never edit
+# a released migration; append a new one instead.
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS weekly_workout_plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            week_start_date DATE NOT NULL,
+            plan_data TEXT NOT NULL,
+            completed_items TEXT DEFAULT '{}',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bmi_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            height REAL NOT NULL,
+            bmi REAL NOT NULL,
+            category TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            dietary_preferences TEXT DEFAULT '',
+            allergies TEXT DEFAULT '',
+            goals TEXT DEFAULT 'maintenance',
+            target_weight REAL,
+            gender TEXT DEFAULT '',
+            age INTEGER,
+            activity_level TEXT DEFAULT '',
+            previous_history TEXT DEFAULT '',
+            prefered_cuisine TEXT DEFAULT '',
+            meal_frequency TEXT DEFAULT '',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS weekly_diet_plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            week_start_date DATE NOT NULL,
+            plan_data TEXT NOT NULL,
+            completed_items TEXT DEFAULT '{}',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_connections (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (friend_id) REFERENCES users (id),
+            UNIQUE(user_id, friend_id),
+            CHECK(status IN ('pending', 'accepted', 'rejected'))
+        )
+        """,
+    ]),
+    (2, "background plan jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            CHECK(status IN ('queued', 'running', 'done', 'failed'))
+        )
+        """,
+    ]),
+    (3, "plan response cache", [
+        """
+        CREATE TABLE IF NOT EXISTS ai_plan_cache (
+            cache_key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            plan_data TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_used_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL
+        )
+        """,
+    ]),
+    (4, "hot query indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_bmi_records_user_created ON bmi_records (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_user_created ON chat_messages (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_diet_plans_user_created ON weekly_diet_plans (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_workout_plans_user_created ON weekly_workout_plans (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_preferences_user_created ON user_preferences (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_connections_friend_status ON user_connections (friend_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_plan_jobs_user ON plan_jobs (user_id)",
+    ]),
+    (5, "chat history keyset index", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_user_id ON chat_messages (user_id, id)",
+    ]),
+    # message/response keep the raw text, *_html the rendered form served to
+    # the page and used for prompt history; NULL until `flask backfill-chat-html`
+    (6, "pre-rendered chat html", [
+        "ALTER TABLE chat_messages ADD COLUMN message_html TEXT",
+        "ALTER TABLE chat_messages ADD COLUMN response_html TEXT",
+    ]),
+    (7, "daily bmi rollup", [
+        """
+        CREATE TABLE IF NOT EXISTS bmi_daily_rollup (
+            user_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            record_count INTEGER NOT NULL,
+            min_bmi REAL,
+            max_bmi REAL,
+            sum_bmi REAL,
+            min_weight REAL,
+            max_weight REAL,
+            sum_weight REAL,
+            first_bmi REAL,
+            first_weight REAL,
+            first_at DATETIME,
+            last_bmi REAL,
+            last_weight REAL,
+            last_height REAL,
+            last_category TEXT,
+            last_at DATETIME,
+            PRIMARY KEY (user_id, day),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        rebuild_rollups,
+    ]),
+    # Bumped on every change to a plan row; feeds the API's ETags
+    (8, "plan row versions", [
+        "ALTER TABLE weekly_diet_plans ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE weekly_workout_plans ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ]),
+    # Diet and workout plans have separate id sequences, hence plan_type in the key
+    (9, "plan item completions", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_item_completions (
+            plan_type TEXT NOT NULL,
+            plan_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (plan_type, plan_id, item_key)
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO plan_item_completions (plan_type, plan_id, item_key, completed)
+        SELECT 'meal', p.id, j.key, CASE WHEN j.value THEN 1 ELSE 0 END
+        FROM weekly_diet_plans p, json_each(p.completed_items) j
+        WHERE json_valid(p.completed_items) AND json_type(p.completed_items) = 'object'
+        """,
+        """
+        INSERT OR IGNORE INTO plan_item_completions (plan_type, plan_id, item_key, completed)
+        SELECT 'workout', p.id, j.key, CASE WHEN j.value THEN 1 ELSE 0 END
+        FROM weekly_workout_plans p, json_each(p.completed_items) j
+        WHERE json_valid(p.completed_items) AND json_type(p.completed_items) = 'object'
+        """,
+    ]),
+    (10, "daily ai usage", [
+        """
+        CREATE TABLE IF NOT EXISTS ai_usage (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    ]),
+    # Concurrent identical plan requests share the in-flight job with their dedupe_key
+    (11, "plan job coalescing", [
+        "ALTER TABLE plan_jobs ADD COLUMN dedupe_key TEXT",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_plan_jobs_in_flight
+        ON plan_jobs (dedupe_key) WHERE status IN ('queued', 'running')
+        """,
+    ]),
+    (12, "chat history summaries", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            through_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    ]),
+    # One checkpoint per week, plan kind and user for the nightly pre-generation run
+    (13, "plan pre-generation checkpoints", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_pregeneration (
+            week_start_date DATE NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (week_start_date, kind, user_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_diet_plans_user_week ON weekly_diet_plans (user_id, week_start_date)",
+        "CREATE INDEX IF NOT EXISTS idx_workout_plans_user_week ON weekly_workout_plans (user_id, week_start_date)",
+    ]),
+    # Plans live compressed and deduplicated in plan_blobs; rows keep only the hash
+    (14, "plan blob storage", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS plan_archive (
+            plan_type TEXT NOT NULL,
+            plan_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            week_start_date DATE NOT NULL,
+            plan_hash TEXT NOT NULL,
+            completed_items TEXT,
+            created_at DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (plan_type, plan_id),
+            FOREIGN KEY (plan_hash) REFERENCES plan_blobs (hash)
+        )
+        """,
+        "ALTER TABLE weekly_diet_plans ADD COLUMN plan_hash TEXT REFERENCES plan_blobs (hash)",
+        "ALTER TABLE weekly_workout_plans ADD COLUMN plan_hash TEXT REFERENCES plan_blobs (hash)",
+        migrate_plan_data,
+        "ALTER TABLE weekly_diet_plans DROP COLUMN plan_data",
+        "ALTER TABLE weekly_workout_plans DROP COLUMN plan_data",
+        "CREATE INDEX IF NOT EXISTS idx_diet_plans_hash ON weekly_diet_plans (plan_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_workout_plans_hash ON weekly_workout_plans (plan_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_plan_archive_hash ON plan_archive (plan_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_plan_archive_user ON plan_archive (user_id, week_start_date)",
+    ]),
+    # Workers refresh updated_at on the in-flight jobs they own; only jobs
+    # whose owner stopped doing so are failed by recovery
+    (15, "plan job owners", [
+        "ALTER TABLE plan_jobs ADD COLUMN owner TEXT",
+        """
+        CREATE INDEX IF NOT EXISTS idx_plan_jobs_owner
+        ON plan_jobs (owner) WHERE status IN ('queued', 'running')
+        """,
+    ]),
+]
+
+
+def current_version(db):
+    # cs50 logs every failed statement; a missing table is expected on a fresh database
+    cs50_logger = logging.getLogger("cs50")
+    disabled = cs50_logger.disabled
+    cs50_logger.disabled = True
+    try:
+        return db.execute("SELECT MAX(version) AS version FROM schema_version")[0]["version"] or 0
+    except RuntimeError as e:
+        if "no such table" not in str(e).lower():
+            raise
+        return 0
+    finally:
+        cs50_logger.disabled = disabled
+
+
+def migrate(db, migrations=MIGRATIONS):
+    """Bring the schema up to the latest version; a no-op costs one version check."""
+    latest = migrations[-1][0] if migrations else 0
+    if current_version(db) >= latest:
+        return 0
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    applied = 0
+    for version, name, steps in migrations:
+        # Each migration is its own transaction; re-checking inside it keeps
+        # concurrently starting workers from applying the same step twice
+        with db.transaction():
+            if current_version(db) >= version:
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", version, name)
+        applied += 1
+    return applied
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(sys_prompt, profile, model):
+    """Content address for a plan request: same prompt + profile + model, same key."""
+    normalized = json.dumps(profile, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    digest = hashlib.sha256()
+    for part in (model, sys_prompt, normalized):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class PlanCache:
+    """SQLite-backed cache of generated plans with TTL and LRU eviction.
+
+    Only validated plans are stored, so a bad completion is never replayed.
+    """
+
+    def __init__(self, db, ttl_seconds=7 * 24 * 3600, max_entries=5000):
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    def get(self, key):
+        rows = self.db.execute("""
+            SELECT plan_data FROM ai_plan_cache
+            WHERE cache_key = ? AND expires_at > CURRENT_TIMESTAMP
+        """, key)
+        if not rows:
+            return None
+        self.db.execute(
+            "UPDATE ai_plan_cache SET last_used_at = CURRENT_TIMESTAMP, hits = hits + 1 WHERE cache_key = ?",
+            key
+        )
+        try:
+            return json.loads(rows[0]["plan_data"])
+        except ValueError:
+            logger.warning(f"Dropping unreadable plan cache entry {key}")
+            self.db.execute("DELETE FROM ai_plan_cache WHERE cache_key = ?", key)
+            return None
+
+    def put(self, key, kind, plan):
+        self.db.execute("""
+            INSERT INTO ai_plan_cache (cache_key, kind, plan_data, expires_at)
+            VALUES (?, ?, ?, datetime('now', ?))
+            ON CONFLICT(cache_key) DO UPDATE SET
+                plan_data = excluded.plan_data,
+                expires_at = excluded.expires_at,
+                last_used_at = CURRENT_TIMESTAMP
+        """, key, kind, json.dumps(plan, ensure_ascii=False), f"+{int(self.ttl_seconds)} seconds")
+        self.evict()
+
+    def evict(self):
+        self.db.execute("DELETE FROM ai_plan_cache WHERE expires_at <= CURRENT_TIMESTAMP")
+        # Least recently used entries beyond the size cap
+        self.db.execute("""
+            DELETE FROM ai_plan_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM ai_plan_cache
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+        """, self.max_entries)
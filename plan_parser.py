@@ -0,0 +1,329 @@
+"""Tolerant, incremental parsing and schema validation of AI plan output.
+
+The scanner copies the first JSON object out of a completion one character
+at a time. It skips code fences and prose around the object, drops
+trailing commas, and when the output is cut off it closes the object after
+the last complete value. Validation then names the exact day, meal or
+exercise that is missing or malformed, so only those parts need to be
+requested again.
+"""
+import json
+
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+CLOSERS = {"{": "}", "[": "]"}
+LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+class PlanParseError(ValueError):
+    pass
+
+
+class Optional:
+    """Schema marker for a field that may be absent."""
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+DIET_DAY = {"breakfast": str, "lunch": str, "dinner": str, "snacks": [str]}
+EXERCISE = {
+    "exercise": str,
+    "sets": (int, float, str),
+    "reps": (int, float, str),
+    "notes": Optional(str),
+}
+WORKOUT_DAY = {"workout": [EXERCISE], "rest": Optional(bool)}
+
+PLAN_SCHEMAS = {
+    "diet": {
+        "calories_target": Optional(str),
+        "focus": Optional(str),
+        "rules": Optional([str]),
+        "week": {day: DIET_DAY for day in DAY_NAMES},
+        "shopping_list": Optional([str]),
+        "notes": Optional([str]),
+    },
+    "workout": {
+        "focus": Optional(str),
+        "rules": Optional([str]),
+        "week": {day: WORKOUT_DAY for day in DAY_NAMES},
+        "equipment_needed": Optional([str]),
+        "notes": Optional([str]),
+    },
+}
+
+
+class _Frame:
+    __slots__ = ("kind", "state", "key", "start")
+
+    def __init__(self, kind, start):
+        self.kind = kind
+        # Objects go key -> colon -> value -> comma; arrays value -> comma
+        self.state = "key" if kind == "{" else "value"
+        self.key = None
+        self.start = start
+
+
+class PlanParser:
+    """Incremental scanner: feed() completion text as it arrives, then finish().
+
+    `on_day(day, value)` is called as soon as each day object under "week"
+    closes, so a streaming caller can render days before the week is done.
+    """
+
+    def __init__(self, on_day=None):
+        self.on_day = on_day
+        self.out = []
+        self.stack = []
+        self.position = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.literal = None
+        self.started = False
+        self.done = False
+        # Where to cut, and what is open there, if the output stops early
+        self.safe = None
+
+    def feed(self, text):
+        for ch in text:
+            if self.done:
+                return
+            self.position += 1
+            self._char(ch)
+
+    def finish(self):
+        """Return (object, complete); `complete` is False when it had to be closed early."""
+        if not self.started:
+            raise PlanParseError("No JSON object found in the response")
+        if self.done:
+            return self._loads("".join(self.out)), True
+        if self.safe is None:
+            raise PlanParseError("Response ended before any complete field")
+        length, open_kinds = self.safe
+        text = "".join(self.out[:length]) + "".join(CLOSERS[kind] for kind in reversed(open_kinds))
+        return self._loads(text), False
+
+    def _loads(self, text):
+        try:
+            return json.loads(text, strict=False)
+        except ValueError as e:
+            raise PlanParseError(f"Malformed JSON: {e}") from e
+
+    def _fail(self, message):
+        raise PlanParseError(f"{message} at character {self.position}")
+
+    def _char(self, ch):
+        if not self.started:
+            # Anything before the object (prose, a ```json fence) is skipped
+            if ch == "{":
+                self.started = True
+                self._open(ch)
+            return
+        if self.in_string:
+            self.out.append(ch)
+            if self.escape:
+                self.escape = False
+            elif ch == "\\":
+                self.escape = True
+            elif ch == '"':
+                self.in_string = False
+                self._string_done()
+            return
+        if self.literal is not None:
+            if not ch.isspace() and ch not in ',:]}"{[':
+                self.literal.append(ch)
+                return
+            self._literal_done()
+        if ch.isspace():
+            return
+        top = self.stack[-1]
+        if ch == '"':
+            if top.state not in ("key", "value"):
+                self._fail("Unexpected string")
+            self.in_string = True
+            self.string_start = len(self.out)
+            self.out.append(ch)
+        elif ch in "{[":
+            if top.state != "value":
+                self._fail(f"Unexpected {ch!r}")
+            self._open(ch)
+        elif ch in "}]":
+            self._close(ch)
+        elif ch == ",":
+            # A comma only counts after a value; doubled commas are dropped
+            if top.state == "comma":
+                self.out.append(ch)
+                top.state = "key" if top.kind == "{" else "value"
+        elif ch == ":":
+            if top.state != "colon":
+                self._fail("Unexpected ':'")
+            self.out.append(ch)
+            top.state = "value"
+        else:
+            if top.state != "value":
+                self._fail(f"Unexpected {ch!r}")
+            self.literal = [ch]
+
+    def _open(self, kind):
+        self.stack.append(_Frame(kind, len(self.out)))
+        self.out.append(kind)
+
+    def _close(self, ch):
+        frame = self.stack[-1]
+        if CLOSERS[frame.kind] != ch:
+            self._fail(f"Mismatched {ch!r}")
+        if frame.state in ("colon", "value") and not (frame.kind == "[" and frame.state == "value"):
+            self._fail("Object member without a value")
+        if self.out[-1] == ",":
+            self.out.pop()
+        self.out.append(ch)
+        self.stack.pop()
+        if not self.stack:
+            self.done = True
+            return
+        if (self.on_day and frame.kind == "{" and len(self.stack) == 2
+                and self.stack[0].key == "week" and self.stack[1].key in DAY_NAMES):
+            self.on_day(self.stack[1].key, self._loads("".join(self.out[frame.start:])))
+        self._value_done()
+
+    def _string_done(self):
+        top = self.stack[-1]
+        if top.state == "key":
+            top.key = self._loads("".join(self.out[self.string_start:]))
+            top.state = "colon"
+        else:
+            self._value_done()
+
+    def _literal_done(self):
+        literal = "".join(self.literal)
+        self.literal = None
+        self.out.append(LITERALS.get(literal, literal))
+        self._value_done()
+
+    def _value_done(self):
+        self.stack[-1].state = "comma"
+        self.safe = (len(self.out), tuple(frame.kind for frame in self.stack))
+
+
+def validate(value, schema, path=()):
+    """List of (path, problem) pairs; an empty list means `value` matches `schema`."""
+    if isinstance(schema, Optional):
+        # Models fill optional fields they have nothing for with null or ""
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return []
+        schema = schema.schema
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [(path, "expected an object")]
+        errors = []
+        for key, sub_schema in schema.items():
+            if key not in value:
+                if not isinstance(sub_schema, Optional):
+                    errors.append((path + (key,), "missing"))
+                continue
+            errors.extend(validate(value[key], sub_schema, path + (key,)))
+        return errors
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            return [(path, "expected a list")]
+        errors = []
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema[0], path + (index,)))
+        return errors
+    if not isinstance(value, schema):
+        return [(path, f"unexpected {type(value).__name__}")]
+    if isinstance(value, str) and not value.strip():
+        return [(path, "empty")]
+    return []
+
+
+def format_errors(errors):
+    def dotted(path):
+        return "".join(f"[{part}]" if isinstance(part, int) else f".{part}" for part in path).lstrip(".")
+    return "; ".join(f"{dotted(path) or 'plan'}: {problem}" for path, problem in errors)
+
+
+def parse_plan(kind, text, on_day=None):
+    """Parse and validate a plan completion; returns (plan, errors).
+
+    Optional top-level fields that fail validation are dropped rather than
+    reported, so the remaining errors are about the plan itself.
+    """
+    parser = PlanParser(on_day)
+    parser.feed(text or "")
+    plan, _ = parser.finish()
+    schema = PLAN_SCHEMAS[kind]
+    errors = validate(plan, schema)
+    for path, _ in errors:
+        if path and isinstance(schema.get(path[0]), Optional):
+            plan.pop(path[0], None)
+    errors = [(path, problem) for path, problem in errors
+              if not (path and isinstance(schema.get(path[0]), Optional))]
+    return plan, errors
+
+
+def broken_days(errors):
+    """Days that have to be requested again, in week order."""
+    days = set()
+    for path, _ in errors:
+        if len(path) < 2 or path[0] != "week":
+            # The week itself, or the whole plan, is unusable
+            return list(DAY_NAMES)
+        days.add(path[1])
+    return [day for day in DAY_NAMES if day in days]
+
+
+def merge_days(plan, patch, days):
+    """Copy `days` from a partial plan into `plan`, keeping the week in day order."""
+    week = plan.get("week") if isinstance(plan.get("week"), dict) else {}
+    patch_week = patch.get("week") if isinstance(patch, dict) and isinstance(patch.get("week"), dict) else {}
+    for day in days:
+        if day in patch_week:
+            week[day] = patch_week[day]
+    plan["week"] = {day: week[day] for day in DAY_NAMES if day in week}
+    return plan
+
+
+def repair_request(days):
+    return (
+        "Your previous reply was incomplete or malformed for some days. "
+        "Reply with the same JSON format, but with \"week\" containing only these days: "
+        f"{', '.join(days)}. Omit every other field."
+    )
+
+
+def parse_slice(kind, text, day, meal=None):
+    """Parse a regenerated day, or one meal of it, and return just that value.
+
+    Accepts the requested {"week": {day: ...}} shape as well as the day or
+    meal object on its own. Raises PlanParseError naming what is wrong.
+    """
+    parser = PlanParser()
+    parser.feed(text or "")
+    value, _ = parser.finish()
+    for key in ("week", day):
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+    schema = PLAN_SCHEMAS[kind]["week"][day]
+    path = ("week", day)
+    if meal is not None:
+        if isinstance(value, dict) and meal in value:
+            value = value[meal]
+        schema, path = schema[meal], path + (meal,)
+    errors = validate(value, schema, path)
+    if errors:
+        raise PlanParseError(format_errors(errors))
+    return value
+
+
+def slice_request(day, meal=None):
+    if meal is not None:
+        return (
+            f"Suggest a different {meal} for {day} that keeps to the same constraints and the plan's "
+            f"calorie target. Reply with only {{\"week\": {{\"{day}\": {{\"{meal}\": ...}}}}}}."
+        )
+    return (
+        f"Create a new plan for {day} only, keeping to the same constraints and day format. "
+        f"Reply with only {{\"week\": {{\"{day}\": {{...}}}}}}."
+    )
@@ -0,0 +1,131 @@
+"""Compressed, content-addressed storage for generated plans.
+
+A plan is serialised to compact JSON (key order is kept, it is the day
+order), hashed, and stored zlib-compressed once in plan_blobs; plan rows
+only hold the hash. Identical plans, common when the plan cache serves
+several users with the same profile, share one blob.
+"""
+import hashlib
+import json
+import logging
+import zlib
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+PLAN_TABLES = {"meal": "weekly_diet_plans", "workout": "weekly_workout_plans"}
+# Generator kind (plan jobs, pre-generation) -> plan type (URLs, PLAN_TABLES, completions)
+PLAN_TYPES = {"diet": "meal", "workout": "workout"}
+COMPRESSION_LEVEL = 9
+MIGRATION_BATCH_SIZE = 1000
+
+
+def week_start(day=None):
+    """Monday of the week containing `day` (today by default); plans are stored per week."""
+    day = day or date.today()
+    return day - timedelta(days=day.weekday())
+
+
+def canonical_json(plan):
+    return json.dumps(plan, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_text(text):
+    """(hash, compressed bytes, uncompressed size) for serialised plan text."""
+    raw = text.encode("utf-8")
+    return hashlib.sha256(raw).hexdigest(), zlib.compress(raw, COMPRESSION_LEVEL), len(raw)
+
+
+def decode_plan(data):
+    return json.loads(zlib.decompress(data))
+
+
+def store_plan(db, plan):
+    """Save `plan` once and return its hash for the plan row to reference.
+
+    Call it in the same transaction as the write that references the hash;
+    otherwise prune_blobs() can delete a shared blob in between.
+    """
+    plan_hash, data, size = encode_text(canonical_json(plan))
+    db.execute("""
+        INSERT INTO plan_blobs (hash, data, size) VALUES (?, ?, ?)
+        ON CONFLICT(hash) DO NOTHING
+    """, plan_hash, data, size)
+    return plan_hash
+
+
+def migrate_plan_data(db, batch_size=MIGRATION_BATCH_SIZE):
+    """Move plan_data text from both plan tables into plan_blobs (migration step).
+
+    Rows are read `batch_size` at a time by id and each batch is written
+    before the next is read, so memory use does not grow with the table.
+    """
+    for table in PLAN_TABLES.values():
+        last_id, moved, stored = 0, 0, 0
+        while True:
+            rows = db.execute(f"SELECT id, plan_data FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                              last_id, batch_size)
+            if not rows:
+                break
+            blobs, links = {}, []
+            for row in rows:
+                try:
+                    text = canonical_json(json.loads(row["plan_data"]))
+                except (TypeError, ValueError):
+                    # Keep unreadable rows byte for byte; they fail on load exactly as before
+                    text = row["plan_data"] or ""
+                plan_hash, data, size = encode_text(text)
+                blobs[plan_hash] = (plan_hash, data, size)
+                links.append((plan_hash, row["id"]))
+            stored += db.executemany("""
+                INSERT INTO plan_blobs (hash, data, size) VALUES (?, ?, ?)
+                ON CONFLICT(hash) DO NOTHING
+            """, blobs.values())
+            db.executemany(f"UPDATE {table} SET plan_hash = ? WHERE id = ?", links)
+            moved += len(links)
+            last_id = rows[-1]["id"]
+        logger.info(f"Moved {moved} {table} rows into {stored} new plan blobs")
+
+
+def prune_blobs(db):
+    """Delete blobs no plan row or archived plan points at; returns how many."""
+    return db.execute("""
+        DELETE FROM plan_blobs
+        WHERE NOT EXISTS (SELECT 1 FROM weekly_diet_plans p WHERE p.plan_hash = plan_blobs.hash)
+          AND NOT EXISTS (SELECT 1 FROM weekly_workout_plans p WHERE p.plan_hash = plan_blobs.hash)
+          AND NOT EXISTS (SELECT 1 FROM plan_archive a WHERE a.plan_hash = plan_blobs.hash)
+    """)
+
+
+def archive_plans(db, before, drop=False):
+    """Move plans whose week started before `before` out of the live tables.
+
+    Archived plans keep their blob and completion ticks in plan_archive;
+    with `drop` they are deleted outright. Either way their rows in
+    plan_item_completions go, and blobs nothing points at any more are
+    pruned. Returns (plans moved or dropped, blobs pruned).
+    """
+    moved = 0
+    for plan_type, table in PLAN_TABLES.items():
+        with db.transaction():
+            if not drop:
+                db.execute(f"""
+                    INSERT INTO plan_archive
+                        (plan_type, plan_id, user_id, week_start_date, plan_hash, completed_items, created_at)
+                    SELECT ?, p.id, p.user_id, p.week_start_date, p.plan_hash,
+                        (SELECT json_group_object(c.item_key, json('true'))
+                         FROM plan_item_completions c
+                         WHERE c.plan_type = ? AND c.plan_id = p.id AND c.completed = 1),
+                        p.created_at
+                    FROM {table} p
+                    WHERE p.week_start_date < ?
+                """, plan_type, plan_type, before)
+            db.execute(f"""
+                DELETE FROM plan_item_completions
+                WHERE plan_type = ? AND plan_id IN (SELECT id FROM {table} WHERE week_start_date < ?)
+            """, plan_type, before)
+            moved += db.execute(f"DELETE FROM {table} WHERE week_start_date < ?", before)
+    with db.transaction():
+        pruned = prune_blobs(db)
+    logger.info(f"{'Dropped' if drop else 'Archived'} {moved} plans from before {before}, pruned {pruned} blobs")
+    return moved, pruned
@@ -0,0 +1,133 @@
+"""Off-peak pre-generation of the week's plans for users who do not have one yet.
+
+Every (week, kind, user) gets a checkpoint row in plan_pregeneration, so a
+run that is interrupted or stopped at its deadline picks up where it left
+off, and failed users are retried a bounded number of times. At most
+`concurrency` plans are generated at once.
+"""
+import logging
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from plan_store import PLAN_TABLES, PLAN_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Whether a user already has a plan for a week: (user_id, week_start_date)
+EXISTING_PLAN_SQL = "SELECT id FROM {table} WHERE user_id = ? AND week_start_date = ?"
+
+
+class PlanPregenerator:
+    """Generates missing weekly plans through `generators[kind](user_id, week_start=...)`.
+
+    A generator returns None when the user's profile is incomplete; the user
+    is then skipped for that week rather than retried.
+    """
+
+    def __init__(self, db, app, generators, concurrency=2, max_attempts=3, batch_size=100, clock=time.monotonic):
+        self.db = db
+        self.app = app
+        self.generators = generators
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.clock = clock
+
+    def pending(self, kind, week, after_id=0, active_weeks=4):
+        """Next batch of user ids, in id order, that still need a `kind` plan for `week`."""
+        table = PLAN_TABLES[PLAN_TYPES[kind]]
+        week = week.isoformat()
+        # active_weeks = 0 means every user, not just those who used plans recently
+        return [row["id"] for row in self.db.execute(f"""
+            SELECT u.id FROM users u
+            WHERE u.id > ?
+              AND NOT EXISTS (
+                SELECT 1 FROM {table} p WHERE p.user_id = u.id AND p.week_start_date = ?)
+              AND (? = 0 OR EXISTS (
+                SELECT 1 FROM {table} p
+                WHERE p.user_id = u.id AND p.week_start_date >= date(?, '-' || (? * 7) || ' days')))
+              AND NOT EXISTS (
+                SELECT 1 FROM plan_pregeneration c
+                WHERE c.week_start_date = ? AND c.kind = ? AND c.user_id = u.id
+                  AND (c.status IN ('done', 'skipped') OR c.attempts >= ?))
+            ORDER BY u.id
+            LIMIT ?
+        """, after_id, week, active_weeks, week, active_weeks, week, kind, self.max_attempts,
+            self.batch_size)]
+
+    def run(self, week, kinds=tuple(PLAN_TYPES), limit=None, active_weeks=4, max_seconds=None):
+        """Generate missing plans for `week`; returns counts per status.
+
+        Stops handing out new users once `limit` plans have been started or
+        `max_seconds` have passed, letting started ones finish; the next run
+        resumes from the checkpoints.
+        """
+        counts = {"done": 0, "skipped": 0, "failed": 0}
+        started_at = self.clock()
+        submitted = 0
+
+        def out_of_budget():
+            return ((limit is not None and submitted >= limit)
+                    or (max_seconds is not None and self.clock() - started_at >= max_seconds))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="plan-pregen") as executor:
+            in_flight = set()
+
+            def collect(return_when):
+                nonlocal in_flight
+                finished, in_flight = wait(in_flight, return_when=return_when)
+                for future in finished:
+                    counts[future.result()] += 1
+
+            for kind in kinds:
+                after_id = 0
+                while not out_of_budget():
+                    user_ids = self.pending(kind, week, after_id, active_weeks)
+                    if not user_ids:
+                        break
+                    for user_id in user_ids:
+                        if out_of_budget():
+                            break
+                        # Keep only `concurrency` users in flight so the batch query stays the only backlog
+                        if len(in_flight) >= self.concurrency:
+                            collect(FIRST_COMPLETED)
+                        in_flight.add(executor.submit(self._generate, kind, user_id, week))
+                        submitted += 1
+                    after_id = user_ids[-1]
+            if in_flight:
+                collect(ALL_COMPLETED)
+        logger.info(f"Plan pre-generation for week of {week}: {counts}")
+        return counts
+
+    def _checkpoint(self, kind, user_id, week, status, error=None):
+        self.db.execute("""
+            UPDATE plan_pregeneration SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE week_start_date = ? AND kind = ? AND user_id = ?
+        """, status, error, week.isoformat(), kind, user_id)
+
+    def _generate(self, kind, user_id, week):
+        with self.app.app_context():
+            try:
+                self.db.execute("""
+                    INSERT INTO plan_pregeneration (week_start_date, kind, user_id, status, attempts)
+                    VALUES (?, ?, ?, 'running', 1)
+                    ON CONFLICT (week_start_date, kind, user_id) DO UPDATE SET
+                        status = 'running', error = NULL, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                """, week.isoformat(), kind, user_id)
+                # The user may have generated one themselves since the batch was read
+                table = PLAN_TABLES[PLAN_TYPES[kind]]
+                if self.db.execute(EXISTING_PLAN_SQL.format(table=table), user_id, week.isoformat()):
+                    self._checkpoint(kind, user_id, week, "done")
+                    return "done"
+                if self.generators[kind](user_id, week_start=week) is None:
+                    self._checkpoint(kind, user_id, week, "skipped", "missing_profile")
+                    return "skipped"
+                self._checkpoint(kind, user_id, week, "done")
+                return "done"
+            except Exception as e:
+                logger.error(f"Pre-generating {kind} plan for user {user_id} failed: {e}")
+                try:
+                    self._checkpoint(kind, user_id, week, "failed", str(e))
+                except Exception:
+                    logger.exception(f"Could not record failure for user {user_id}")
+                return "failed"
@@ -0,0 +1,70 @@
+"""In-process cache of each user's profile context: latest BMI record and preferences.
+
+Chat turns, plan generation, the dashboard and the preferences page all
+read the same two rows. Entries expire after `ttl` seconds and the least
+recently used are evicted beyond `max_users`. Writers must call
+invalidate(); other worker processes see a write once their entry expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ProfileCache:
+    """`load(user_id)` returns (latest BMI row or None, preferences row or None).
+
+    get() hands out copies, so callers may modify the rows they receive.
+    """
+
+    def __init__(self, load, ttl=60, max_users=1000, clock=time.monotonic):
+        self.load = load
+        self.ttl = ttl
+        self.max_users = max_users
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped by every invalidate(); a load that straddles one is not cached
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return self._copy(entry[1])
+            self.misses += 1
+            epoch = self.epoch
+        context = self.load(user_id)
+        with self.lock:
+            if self.epoch == epoch:
+                self.entries[user_id] = (now, context)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_users:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return self._copy(context)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.epoch += 1
+            self.entries.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self.entries),
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+    @staticmethod
+    def _copy(context):
+        return tuple(dict(row) if row is not None else None for row in context)
@@ -0,0 +1,131 @@
+"""Per-user request rate limits and daily AI call quotas.
+
+Both take an injectable clock so tests and scripts can move time by hand.
+"""
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimited(Exception):
+    """Raised when a request must wait; `retry_after` is in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class QuotaExceeded(RateLimited):
+    pass
+
+
+class RateLimiter:
+    """In-process token buckets keyed by (user, route).
+
+    Each bucket holds up to `burst` requests and refills at `per_minute`.
+    Limits are per worker process; the daily quota is the cross-process cap.
+    """
+
+    def __init__(self, clock=time.monotonic, max_keys=10000):
+        self.clock = clock
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def hit(self, key, per_minute, burst):
+        """Take one request from `key`'s bucket or raise RateLimited."""
+        rate = per_minute / 60
+        with self.lock:
+            now = self.clock()
+            tokens, updated_at, _ = self.buckets.get(key, (burst, now, 0))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, (burst - tokens) / rate)
+                raise RateLimited("Too many requests, please slow down", (1 - tokens) / rate)
+            tokens -= 1
+            # Each bucket keeps the seconds until it is full again, for pruning
+            self.buckets[key] = (tokens, now, (burst - tokens) / rate)
+            if len(self.buckets) > self.max_keys:
+                self._prune(now)
+
+    def _prune(self, now):
+        # A bucket that would have refilled completely is the same as no bucket
+        for key, (_, updated_at, full_after) in list(self.buckets.items()):
+            if now - updated_at >= full_after:
+                del self.buckets[key]
+
+
+class DailyQuota:
+    """Per-user AI calls per UTC day, counted in the ai_usage table.
+
+    Counts are cached in memory per user and day. A day's count only grows,
+    so a cached "used up" answer is always correct and needs no query; a
+    cached count under the limit may lag other workers, so charge() decides
+    against the database.
+    """
+
+    def __init__(self, db, limit, clock=time.time):
+        self.db = db
+        self.limit = limit
+        self.clock = clock
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def _now(self):
+        return datetime.fromtimestamp(self.clock(), timezone.utc)
+
+    def _day(self):
+        return self._now().date().isoformat()
+
+    def _exceeded(self):
+        now = self._now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), timezone.utc)
+        return QuotaExceeded(
+            f"Daily AI limit of {self.limit} requests reached, try again tomorrow",
+            (midnight - now).total_seconds()
+        )
+
+    def _remember(self, user_id, day, calls):
+        with self.lock:
+            self.cache[user_id] = (day, calls)
+
+    def _used_up(self, user_id, day):
+        cached = self.cache.get(user_id)
+        return bool(self.limit) and cached is not None and cached[0] == day and cached[1] >= self.limit
+
+    def used(self, user_id):
+        day = self._day()
+        cached = self.cache.get(user_id)
+        if cached and cached[0] == day:
+            return cached[1]
+        rows = self.db.execute("SELECT calls FROM ai_usage WHERE user_id = ? AND day = ?", user_id, day)
+        calls = rows[0]["calls"] if rows else 0
+        self._remember(user_id, day, calls)
+        return calls
+
+    def check(self, user_id):
+        """Raise QuotaExceeded if the user has no calls left today; charges nothing."""
+        if self.limit and self.used(user_id) >= self.limit:
+            raise self._exceeded()
+
+    def charge(self, user_id):
+        """Count one AI call against today's quota, or raise QuotaExceeded."""
+        day = self._day()
+        if self._used_up(user_id, day):
+            raise self._exceeded()
+        with self.db.transaction():
+            rows = self.db.execute("SELECT calls FROM ai_usage WHERE user_id = ? AND day = ?", user_id, day)
+            calls = rows[0]["calls"] if rows else 0
+            if self.limit and calls >= self.limit:
+                self._remember(user_id, day, calls)
+                raise self._exceeded()
+            self.db.execute("""
+                INSERT INTO ai_usage (user_id, day, calls) VALUES (?, ?, 1)
+                ON CONFLICT(user_id, day) DO UPDATE SET calls = calls + 1
+            """, user_id, day)
+        self._remember(user_id, day, calls + 1)
+        return calls + 1
@@ -0,0 +1,177 @@
+"""Per-user, per-day BMI rollups kept in step with bmi_records.
+
+Views read first/last/count aggregates from here, so their cost grows with
+the number of days in range rather than the number of raw records.
+"""
+from operator import itemgetter
+
+# Recomputes rollup rows from bmi_records; `{where}` narrows it to one user
+REBUILD_SQL = """
+    INSERT INTO bmi_daily_rollup (
+        user_id, day, record_count,
+        min_bmi, max_bmi, sum_bmi, min_weight, max_weight, sum_weight,
+        first_bmi, first_weight, first_at,
+        last_bmi, last_weight, last_height, last_category, last_at
+    )
+    SELECT user_id, day, COUNT(*),
+           MIN(bmi), MAX(bmi), SUM(bmi), MIN(weight), MAX(weight), SUM(weight),
+           MAX(first_bmi), MAX(first_weight), MIN(created_at),
+           MAX(last_bmi), MAX(last_weight), MAX(last_height), MAX(last_category), MAX(created_at)
+    FROM (
+        SELECT user_id, date(created_at) AS day, bmi, weight, created_at,
+               FIRST_VALUE(bmi) OVER w AS first_bmi,
+               FIRST_VALUE(weight) OVER w AS first_weight,
+               LAST_VALUE(bmi) OVER w AS last_bmi,
+               LAST_VALUE(weight) OVER w AS last_weight,
+               LAST_VALUE(height) OVER w AS last_height,
+               LAST_VALUE(category) OVER w AS last_category
+        FROM bmi_records
+        {where}
+        WINDOW w AS (
+            PARTITION BY user_id, date(created_at)
+            ORDER BY created_at, id
+            ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+        )
+    )
+    GROUP BY user_id, day
+"""
+
+
+# Folds incoming day rows into existing ones; records may arrive out of
+# order, so first/last are only replaced by older/newer ones
+MERGE_SQL = """
+    ON CONFLICT(user_id, day) DO UPDATE SET
+        record_count = record_count + excluded.record_count,
+        min_bmi = MIN(min_bmi, excluded.min_bmi),
+        max_bmi = MAX(max_bmi, excluded.max_bmi),
+        sum_bmi = sum_bmi + excluded.sum_bmi,
+        min_weight = MIN(min_weight, excluded.min_weight),
+        max_weight = MAX(max_weight, excluded.max_weight),
+        sum_weight = sum_weight + excluded.sum_weight,
+        first_bmi = CASE WHEN excluded.first_at < first_at THEN excluded.first_bmi ELSE first_bmi END,
+        first_weight = CASE WHEN excluded.first_at < first_at THEN excluded.first_weight ELSE first_weight END,
+        first_at = MIN(first_at, excluded.first_at),
+        last_bmi = CASE WHEN excluded.last_at >= last_at THEN excluded.last_bmi ELSE last_bmi END,
+        last_weight = CASE WHEN excluded.last_at >= last_at THEN excluded.last_weight ELSE last_weight END,
+        last_height = CASE WHEN excluded.last_at >= last_at THEN excluded.last_height ELSE last_height END,
+        last_category = CASE WHEN excluded.last_at >= last_at THEN excluded.last_category ELSE last_category END,
+        last_at = MAX(last_at, excluded.last_at)
+"""
+
+
+def rebuild_rollups(db, user_id=None):
+    """Recompute rollups from raw records, for every user or just one."""
+    if user_id is None:
+        db.execute("DELETE FROM bmi_daily_rollup")
+        db.execute(REBUILD_SQL.format(where=""))
+    else:
+        db.execute("DELETE FROM bmi_daily_rollup WHERE user_id = ?", user_id)
+        db.execute(REBUILD_SQL.format(where="WHERE user_id = ?"), user_id)
+
+
+def record_bmi(db, user_id, created_at, weight, height, bmi, category):
+    """Fold one new bmi_records row into its day's rollup.
+
+    `created_at` is the record's 'YYYY-MM-DD HH:MM:SS' timestamp.
+    """
+    db.execute(f"""
+        INSERT INTO bmi_daily_rollup (
+            user_id, day, record_count,
+            min_bmi, max_bmi, sum_bmi, min_weight, max_weight, sum_weight,
+            first_bmi, first_weight, first_at,
+            last_bmi, last_weight, last_height, last_category, last_at
+        )
+        VALUES (:user_id, date(:created_at), 1,
+                :bmi, :bmi, :bmi, :weight, :weight, :weight,
+                :bmi, :weight, :created_at,
+                :bmi, :weight, :height, :category, :created_at)
+        {MERGE_SQL}
+    """, user_id=user_id, created_at=created_at, weight=weight, height=height, bmi=bmi, category=category)
+
+
+def merge_records(db, user_id, records):
+    """Fold newly inserted records into their days' rollups with one executemany.
+
+    `records` are (created_at, weight, height, bmi, category) tuples in
+    insertion order. They are aggregated here rather than re-read, so each
+    bulk-import chunk costs the same however much history already exists.
+    Must run inside db.transaction().
+    """
+    days = {}
+    # Stable sort: equal timestamps keep insertion order, like ORDER BY created_at, id
+    for created_at, weight, height, bmi, category in sorted(records, key=itemgetter(0)):
+        day = days.get(created_at[:10])
+        if day is None:
+            days[created_at[:10]] = [1, bmi, bmi, bmi, weight, weight, weight,
+                                     bmi, weight, created_at, bmi, weight, height, category, created_at]
+            continue
+        day[0] += 1
+        day[1] = min(day[1], bmi)
+        day[2] = max(day[2], bmi)
+        day[3] += bmi
+        day[4] = min(day[4], weight)
+        day[5] = max(day[5], weight)
+        day[6] += weight
+        day[10:15] = bmi, weight, height, category, created_at
+    db.executemany(f"""
+        INSERT INTO bmi_daily_rollup (
+            user_id, day, record_count,
+            min_bmi, max_bmi, sum_bmi, min_weight, max_weight, sum_weight,
+            first_bmi, first_weight, first_at,
+            last_bmi, last_weight, last_height, last_category, last_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        {MERGE_SQL}
+    """, [(user_id, day, *values) for day, values in days.items()])
+
+
+LATEST_BMI_SQL = """
+    SELECT last_bmi AS bmi, last_category AS category, last_weight AS weight,
+           last_height AS height, last_at AS created_at
+    FROM bmi_daily_rollup
+    WHERE user_id = ?
+    ORDER BY day DESC LIMIT 1
+"""
+
+# bmi_summary() queries; parameters are (user_id, start, end)
+SUMMARY_BOUNDS = """
+    WHERE user_id = ?
+      AND day >= COALESCE(?, '0000-01-01')
+      AND day <= COALESCE(?, '9999-12-31')
+"""
+SUMMARY_TOTALS_SQL = f"""
+    SELECT COALESCE(SUM(record_count), 0) AS record_count
+    FROM bmi_daily_rollup {SUMMARY_BOUNDS}
+"""
+SUMMARY_FIRST_SQL = f"""
+    SELECT first_bmi, first_weight FROM bmi_daily_rollup {SUMMARY_BOUNDS}
+    ORDER BY day ASC LIMIT 1
+"""
+SUMMARY_LAST_SQL = f"""
+    SELECT last_bmi, last_weight FROM bmi_daily_rollup {SUMMARY_BOUNDS}
+    ORDER BY day DESC LIMIT 1
+"""
+
+
+def latest_bmi(db, user_id):
+    """Most recent record as a bmi_records-shaped dict, or None."""
+    rows = db.execute(LATEST_BMI_SQL, user_id)
+    return rows[0] if rows else None
+
+
+def bmi_summary(db, user_id, start=None, end=None):
+    """Record count plus first/latest BMI and weight over an optional 'YYYY-MM-DD' range."""
+    totals = db.execute(SUMMARY_TOTALS_SQL, user_id, start, end)[0]
+    if not totals["record_count"]:
+        return {"record_count": 0}
+    first = db.execute(SUMMARY_FIRST_SQL, user_id, start, end)[0]
+    last = db.execute(SUMMARY_LAST_SQL, user_id, start, end)[0]
+    return {
+        "record_count": totals["record_count"],
+        "first_bmi": first["first_bmi"],
+        "first_weight": first["first_weight"],
+        "latest_bmi": last["last_bmi"],
+        "latest_weight": last["last_weight"],
+        "bmi_change": round(last["last_bmi"] - first["first_bmi"], 1),
+        "weight_change": round(last["last_weight"] - first["first_weight"], 1),
+    }
@@ -0,0 +1,45 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# The app is a set of top-level modules in the repository root
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """The app module, imported against a freshly migrated database in a temporary directory.
+
+    app.py opens health.db and the prompt files relative to the working
+    directory, so the session stays in that directory until it ends.
+    """
+    workdir = tmp_path_factory.mktemp("app")
+    for name in ("diet_coach_prompt.txt", "workout_coach_prompt.txt"):
+        shutil.copy(ROOT / name, workdir)
+    # cs50 refuses to open a SQLite file that does not exist
+    (workdir / "health.db").touch()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A migrated database in a temporary file with one user, id 1."""
+    from database import SQL
+    from migrations import migrate
+
+    path = tmp_path / "test.db"
+    path.touch()
+    db = SQL(f"sqlite:///{path}")
+    migrate(db)
+    db.execute("INSERT INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    return db
@@ -0,0 +1,225 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ai_caller
+from ai_caller import AIClient, CircuitBreaker
+
+UNAVAILABLE = "Error: AI service is temporarily unavailable"
+# Bound now so tests that patch time.sleep only see the client's sleeps
+pause = time.sleep
+
+
+def completion(content):
+    return {"choices": [{"message": {"content": content}}]}
+
+
+class StubServer:
+    """Local stand-in for the provider; replies are taken from `script` in order, the last one repeats."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.requests += 1
+                status, body, headers, delay = stub.next_reply()
+                pause(delay)
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    if isinstance(body, str):
+                        payload = body.encode()
+                        self.send_header("Content-Type", "text/event-stream")
+                    else:
+                        payload = json.dumps(body).encode()
+                        self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except OSError:
+                    # The client gave up waiting (timeout tests)
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/chat/completions"
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def next_reply(self):
+        reply = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        status, body, *rest = reply
+        headers = rest[0] if rest else {}
+        delay = rest[1] if len(rest) > 1 else 0
+        return status, body, headers, delay
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(*script):
+        server = StubServer(script)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.close()
+
+
+def make_client(server, **kwargs):
+    kwargs.setdefault("backoff_base", 0)
+    return AIClient(api_url=server.url, api_headers={}, **kwargs)
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retries_retryable_statuses(stub, status):
+    server = stub((status, {"error": "busy"}), (200, completion("hello")))
+    client = make_client(server, max_retries=2)
+    assert client.call("sys", "", "hi") == "hello"
+    assert server.requests == 2
+
+
+def test_gives_up_after_max_retries(stub):
+    server = stub((503, {"error": "down"}))
+    client = make_client(server, max_retries=2)
+    assert client.call("sys", "", "hi").startswith("Error: 503")
+    assert server.requests == 3
+
+
+def test_client_errors_are_not_retried(stub):
+    server = stub((400, {"error": "bad request"}))
+    client = make_client(server, max_retries=2)
+    assert client.call("sys", "", "hi").startswith("Error: 400")
+    assert server.requests == 1
+
+
+def test_honours_retry_after(stub, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ai_caller.time, "sleep", sleeps.append)
+    server = stub((429, {"error": "slow down"}, {"Retry-After": "3"}), (200, completion("ok")))
+    client = make_client(server, max_retries=1, backoff_max=8.0)
+    assert client.call("sys", "", "hi") == "ok"
+    assert sleeps == [3.0]
+
+
+def test_retry_after_is_capped_by_backoff_max(stub, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ai_caller.time, "sleep", sleeps.append)
+    server = stub((503, {}, {"Retry-After": "120"}), (200, completion("ok")))
+    client = make_client(server, max_retries=1, backoff_max=2.0)
+    assert client.call("sys", "", "hi") == "ok"
+    assert sleeps == [2.0]
+
+
+def test_read_timeout_is_retried_then_reported(stub):
+    server = stub((200, completion("late"), {}, 1.0))
+    client = make_client(server, max_retries=1, read_timeout=0.2)
+    started = time.monotonic()
+    result = client.call("sys", "", "hi")
+    assert result.startswith("Error: ReadTimeout")
+    assert server.requests == 2
+    assert time.monotonic() - started < 1.5
+
+
+def test_breaker_opens_half_opens_and_closes(stub):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+    server = stub((503, {}), (503, {}), (200, completion("back")))
+    client = make_client(server, max_retries=0, breaker=breaker)
+
+    assert client.call("sys", "", "hi").startswith("Error: 503")
+    assert client.call("sys", "", "hi").startswith("Error: 503")
+    # Open: fails fast without reaching the upstream
+    assert client.call("sys", "", "hi") == UNAVAILABLE
+    assert server.requests == 2
+
+    now[0] += 30
+    # Half-open: one trial request goes through and its success closes the circuit
+    assert client.call("sys", "", "hi") == "back"
+    assert client.call("sys", "", "hi") == "back"
+    assert server.requests == 4
+
+
+def test_failed_trial_reopens_breaker(stub):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    server = stub((500, {}))
+    client = make_client(server, max_retries=0, breaker=breaker)
+
+    assert client.call("sys", "", "hi").startswith("Error: 500")
+    assert client.call("sys", "", "hi") == UNAVAILABLE
+    now[0] += 10
+    assert client.call("sys", "", "hi").startswith("Error: 500")
+    assert client.call("sys", "", "hi") == UNAVAILABLE
+    assert server.requests == 2
+
+
+def test_async_call_returns_content(stub):
+    server = stub((503, {}), (200, completion("async hello")))
+    client = ai_caller.AsyncAIClient(api_url=server.url, api_headers={}, backoff_base=0, max_retries=1)
+    assert client.session is None
+    assert client.call("sys", "", "hi") == "async hello"
+    assert server.requests == 2
+
+
+def test_async_call_honours_timeout(stub):
+    server = stub((200, completion("late"), {}, 2.0))
+    client = ai_caller.AsyncAIClient(api_url=server.url, api_headers={}, max_retries=0)
+    started = time.monotonic()
+    assert client.call("sys", "", "hi", timeout=0.2) == "Error: Timeout no response within 0.2s"
+    assert time.monotonic() - started < 1.0
+
+
+def sse_body(*deltas):
+    lines = [": OPENROUTER PROCESSING", ""]
+    for delta in deltas:
+        lines += [f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]})}", ""]
+    return "\n".join(lines + ["data: [DONE]", ""])
+
+
+def test_stream_yields_deltas(stub):
+    server = stub((200, sse_body("Hel", "lo")))
+    assert list(make_client(server).stream("sys", "", "hi")) == ["Hel", "lo"]
+
+
+def test_async_stream_shares_the_limits(stub):
+    server = stub((503, {}), (200, sse_body("Hel", "lo")))
+    client = ai_caller.AsyncAIClient(api_url=server.url, api_headers={}, backoff_base=0, max_retries=1,
+                                     max_concurrency=2, rate_per_second=0.001, burst=3)
+    assert list(client.stream("sys", "", "hi")) == ["Hel", "lo"]
+    assert server.requests == 2
+    # Both attempts took a token from the provider rate limit, and the slot is free again
+    assert client.bucket.tokens == pytest.approx(1, abs=0.01)
+    assert client.semaphore._value == 2
+
+
+def test_async_stream_reports_errors(stub):
+    server = stub((400, {"error": "bad"}))
+    client = ai_caller.AsyncAIClient(api_url=server.url, api_headers={}, max_retries=0)
+    chunks = list(client.stream("sys", "", "hi"))
+    assert len(chunks) == 1 and chunks[0].startswith("Error: 400")
+
+
+def test_closing_async_stream_frees_its_slot(stub):
+    server = stub((200, sse_body(*"abcdef")))
+    client = ai_caller.AsyncAIClient(api_url=server.url, api_headers={}, max_concurrency=1)
+    chunks = client.stream("sys", "", "hi")
+    assert next(chunks) == "a"
+    chunks.close()
+    # The next stream needs the only slot
+    assert "".join(client.stream("sys", "", "hi")) == "abcdef"
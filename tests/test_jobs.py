@@ -0,0 +1,51 @@
+import threading
+
+from flask import Flask
+
+from jobs import JobQueue
+
+
+def make_queue(db, **kw):
+    queue = JobQueue(db, Flask(__name__), max_workers=1, **kw)
+    release = threading.Event()
+    queue.register("diet", lambda user_id: release.wait(5) or {})
+    return queue, release
+
+
+def status(db, job_id):
+    return db.execute("SELECT status, error FROM plan_jobs WHERE id = ?", job_id)[0]
+
+
+def test_starting_worker_leaves_live_jobs_of_other_workers_alone(db):
+    running, release = make_queue(db)
+    job_id = running.enqueue("diet", 1, dedupe_key="k")
+    restarted, _ = make_queue(db)
+    assert restarted.recover() == 0
+    assert restarted.enqueue("diet", 1, dedupe_key="k") == job_id
+    release.set()
+    running.executor.shutdown(wait=True)
+    assert status(db, job_id)["status"] == "done"
+
+
+def test_jobs_without_a_heartbeat_are_failed(db):
+    job_id = db.execute("""
+        INSERT INTO plan_jobs (user_id, kind, status, dedupe_key, owner, updated_at)
+        VALUES (1, 'diet', 'running', 'k', 'gone:1:abc', datetime('now', '-10 minutes'))
+    """)
+    queue, release = make_queue(db)
+    assert queue.recover() == 1
+    assert status(db, job_id) == {"status": "failed", "error": "Interrupted by server restart"}
+    # The dedupe key is free for a new run
+    release.set()
+    assert queue.enqueue("diet", 1, dedupe_key="k") != job_id
+
+
+def test_heartbeat_keeps_own_jobs_fresh(db):
+    queue, release = make_queue(db)
+    job_id = queue.enqueue("diet", 1)
+    db.execute("UPDATE plan_jobs SET updated_at = datetime('now', '-10 minutes') WHERE id = ?", job_id)
+    queue.touch()
+    other, _ = make_queue(db)
+    assert other.recover() == 0
+    assert status(db, job_id)["status"] == "running"
+    release.set()
@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+from plan_parser import DAY_NAMES
+from plan_store import store_plan
+
+
+@pytest.fixture
+def client(app_module):
+    db = app_module.db
+    db.execute("INSERT OR IGNORE INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    plan = {"week": {day: {"breakfast": "Oats", "lunch": "Salad", "dinner": "Fish", "snacks": []} for day in DAY_NAMES}}
+    with db.transaction():
+        plan_id = db.execute("""
+            INSERT INTO weekly_diet_plans (user_id, week_start_date, plan_hash)
+            VALUES (1, date('now'), ?)
+        """, store_plan(db, plan))
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+        session["username"] = "alice"
+    yield client
+    db.execute("DELETE FROM weekly_diet_plans WHERE id = ?", plan_id)
+
+
+def test_current_plan_keeps_days_in_week_order(client):
+    response = client.get("/api/v1/plans/meal")
+    assert response.status_code == 200
+    assert list(json.loads(response.data)["plan"]["week"]) == list(DAY_NAMES)
+    again = client.get("/api/v1/plans/meal", headers={"If-None-Match": response.headers["ETag"]})
+    assert again.status_code == 304
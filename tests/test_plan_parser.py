@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from plan_parser import (DAY_NAMES, EXERCISE, Optional, PlanParseError, PlanParser, broken_days, parse_plan,
+                         parse_slice, validate)
+
+
+def diet_week():
+    return {day: {"breakfast": "Oats", "lunch": "Salad", "dinner": "Fish", "snacks": ["Apple"]} for day in DAY_NAMES}
+
+
+def workout_week(**exercise):
+    entry = {"exercise": "Squat", "sets": 3, "reps": "8-10", **exercise}
+    return {day: {"workout": [entry]} for day in DAY_NAMES}
+
+
+@pytest.mark.parametrize("notes", ["", "   ", None])
+def test_blank_optional_field_is_valid(notes):
+    assert validate({"exercise": "Squat", "sets": 3, "reps": 8, "notes": notes}, EXERCISE) == []
+
+
+def test_blank_required_field_is_reported():
+    assert validate({"exercise": "", "sets": 3, "reps": 8}, EXERCISE) == [(("exercise",), "empty")]
+    assert validate({"exercise": None, "sets": 3, "reps": 8}, EXERCISE) == [(("exercise",), "unexpected NoneType")]
+
+
+def test_optional_field_is_still_type_checked():
+    assert validate(3, Optional(str)) == [((), "unexpected int")]
+    assert validate({"rest": "yes"}, {"rest": Optional(bool)}) == [(("rest",), "unexpected str")]
+
+
+@pytest.mark.parametrize("notes", ["", None])
+def test_workout_with_blank_exercise_notes_parses(notes):
+    text = json.dumps({"focus": None, "week": workout_week(notes=notes)})
+    plan, errors = parse_plan("workout", text)
+    assert errors == []
+    assert plan["week"]["Monday"]["workout"][0]["notes"] == notes
+
+
+def test_fences_prose_and_trailing_commas_are_tolerated():
+    body = json.dumps({"calories_target": "2000", "week": diet_week()}, indent=1)
+    body = body.replace('"Apple"\n', '"Apple",\n').replace("}\n}", "},\n}")
+    plan, errors = parse_plan("diet", f"Here is your plan:\n```json\n{body}\n```\nEnjoy!")
+    assert errors == []
+    assert plan["calories_target"] == "2000"
+    assert list(plan["week"]) == list(DAY_NAMES)
+
+
+def test_truncated_output_keeps_complete_days():
+    text = json.dumps({"week": diet_week()})
+    cut = text[:text.index('"Thursday"') + 40]  # inside Thursday, after its breakfast
+    plan, errors = parse_plan("diet", cut)
+    assert list(plan["week"]) == ["Monday", "Tuesday", "Wednesday", "Thursday"]
+    assert broken_days(errors) == ["Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def test_truncated_output_is_reported_incomplete():
+    parser = PlanParser()
+    parser.feed('{"focus": "Strength", "rules": ["a", "b"')
+    value, complete = parser.finish()
+    assert value == {"focus": "Strength", "rules": ["a", "b"]}
+    assert complete is False
+
+
+def test_days_are_reported_as_they_close():
+    seen = []
+    parser = PlanParser(on_day=lambda day, value: seen.append(day))
+    text = json.dumps({"week": diet_week()})
+    parser.feed(text[:text.index('"Wednesday"')])
+    assert seen == ["Monday", "Tuesday"]
+    parser.feed(text[text.index('"Wednesday"'):])
+    assert seen == list(DAY_NAMES)
+
+
+def test_response_without_an_object_is_an_error():
+    with pytest.raises(PlanParseError):
+        parse_plan("diet", "Sorry, I can't help with that.")
+    with pytest.raises(PlanParseError):
+        parse_plan("diet", '{"focus": "Str')
+
+
+def test_slice_accepts_the_bare_meal():
+    assert parse_slice("diet", '{"lunch": "Soup"}', "Monday", "lunch") == "Soup"
+    with pytest.raises(PlanParseError, match="week.Monday.lunch: empty"):
+        parse_slice("diet", '{"week": {"Monday": {"lunch": ""}}}', "Monday", "lunch")
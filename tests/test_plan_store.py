@@ -0,0 +1,40 @@
+import functools
+import json
+
+from database import SQL
+from migrations import MIGRATIONS, migrate
+from plan_store import decode_plan, migrate_plan_data
+
+
+def test_plan_data_is_moved_in_batches(tmp_path):
+    path = tmp_path / "old.db"
+    path.touch()
+    db = SQL(f"sqlite:///{path}")
+    migrate(db, [m for m in MIGRATIONS if m[0] < 14])
+    db.execute("INSERT INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    plans = [{"week": {"Monday": {"lunch": f"Soup {n % 3}"}}} for n in range(7)] + ["not json"]
+    for plan in plans:
+        db.execute("INSERT INTO weekly_diet_plans (user_id, week_start_date, plan_data) VALUES (1, '2026-01-05', ?)",
+                   plan if isinstance(plan, str) else json.dumps(plan, indent=2))
+
+    selects = []
+    execute = db.execute
+
+    def spy(sql, *args, **kwargs):
+        if sql.startswith("SELECT id, plan_data"):
+            selects.append(args)
+        return execute(sql, *args, **kwargs)
+    db.execute = spy
+    version, name, steps = next(m for m in MIGRATIONS if m[0] == 14)
+    steps = [functools.partial(migrate_plan_data, batch_size=3) if step is migrate_plan_data else step
+             for step in steps]
+    migrate(db, [m for m in MIGRATIONS if m[0] < 14] + [(version, name, steps)])
+    db.execute = execute
+
+    # Three batches of diet rows and an empty read to finish, then one empty read of the workout table
+    assert [limit for _, limit in selects] == [3] * 5
+    rows = db.execute("""
+        SELECT b.data FROM weekly_diet_plans p JOIN plan_blobs b ON b.hash = p.plan_hash ORDER BY p.id
+    """)
+    assert [decode_plan(row["data"]) for row in rows[:-1]] == plans[:-1]
+    assert db.execute("SELECT COUNT(*) AS n FROM plan_blobs")[0]["n"] == 4
@@ -0,0 +1,28 @@
+from datetime import date
+
+from flask import Flask
+
+from plan_store import store_plan, week_start
+from pregenerate import PlanPregenerator
+
+
+def test_week_start_is_monday():
+    assert week_start(date(2026, 10, 18)) == date(2026, 10, 12)
+    assert week_start(date(2026, 10, 12)) == date(2026, 10, 12)
+
+
+def test_only_users_without_a_plan_are_generated(db):
+    db.execute("INSERT INTO users (id, username, password) VALUES (2, 'bob', 'x')")
+    week = date(2026, 10, 12)
+    with db.transaction():
+        db.execute("INSERT INTO weekly_diet_plans (user_id, week_start_date, plan_hash) VALUES (1, ?, ?)",
+                   week.isoformat(), store_plan(db, {"week": {}}))
+    generated = []
+
+    def generate(user_id, week_start):
+        generated.append((user_id, week_start))
+        return {}
+    pregenerator = PlanPregenerator(db, Flask(__name__), {"diet": generate, "workout": generate})
+    assert pregenerator.pending("diet", week, active_weeks=0) == [2]
+    assert pregenerator.run(week, ("diet",), active_weeks=0) == {"done": 1, "skipped": 0, "failed": 0}
+    assert generated == [(2, week)]
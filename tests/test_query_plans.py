@@ -0,0 +1,12 @@
+from migrations import MIGRATIONS, current_version
+
+
+def test_hot_queries_use_an_index(app_module):
+    # The fixture's database was created by the app's startup migrations
+    assert current_version(app_module.db) == MIGRATIONS[-1][0]
+    scans = {}
+    for sql, *args in app_module.HOT_QUERIES:
+        found = app_module.full_scans(sql, *args)
+        if found:
+            scans[" ".join(sql.split())] = found
+    assert scans == {}
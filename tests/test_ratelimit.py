@@ -0,0 +1,169 @@
+import pytest
+
+from jobs import JobFailed
+from ratelimit import DailyQuota, QuotaExceeded, RateLimited, RateLimiter
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_refills():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock)
+    for _ in range(3):
+        limiter.hit("k", 60, 3)
+    with pytest.raises(RateLimited) as e:
+        limiter.hit("k", 60, 3)
+    assert e.value.retry_after == 1
+    clock.now += 1
+    limiter.hit("k", 60, 3)
+
+
+def test_retry_after_follows_the_rate():
+    limiter = RateLimiter(clock=FakeClock())
+    limiter.hit("k", 4, 1)
+    with pytest.raises(RateLimited) as e:
+        limiter.hit("k", 4, 1)
+    assert e.value.retry_after == 15
+
+
+def test_keys_have_separate_buckets():
+    limiter = RateLimiter(clock=FakeClock())
+    limiter.hit("a", 60, 1)
+    limiter.hit("b", 60, 1)
+    with pytest.raises(RateLimited):
+        limiter.hit("a", 60, 1)
+
+
+def test_prune_uses_each_keys_own_refill_time():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, max_keys=2)
+    limiter.hit("fast", 60, 1)  # full again after 1s
+    limiter.hit("slow", 1, 2)  # full again after 60s
+    clock.now += 10
+    limiter.hit("new", 60, 1)
+    assert set(limiter.buckets) == {"slow", "new"}
+    # The slow bucket was kept, so its spent token is still spent
+    limiter.hit("slow", 1, 2)
+    with pytest.raises(RateLimited):
+        limiter.hit("slow", 1, 2)
+
+
+def test_quota_counts_calls_per_day(db):
+    clock = FakeClock(86400 * 20000 + 3600)
+    quota = DailyQuota(db, limit=2, clock=clock)
+    assert quota.charge(1) == 1
+    assert quota.charge(1) == 2
+    assert quota.used(1) == 2
+    with pytest.raises(QuotaExceeded) as e:
+        quota.charge(1)
+    assert e.value.retry_after == 23 * 3600
+    with pytest.raises(QuotaExceeded):
+        quota.check(1)
+    clock.now += 23 * 3600
+    quota.check(1)
+    assert quota.charge(1) == 1
+
+
+def test_used_up_quota_answers_without_a_query(db, monkeypatch):
+    quota = DailyQuota(db, limit=1, clock=FakeClock(86400 * 20000))
+    quota.charge(1)
+    with pytest.raises(QuotaExceeded):
+        quota.charge(1)
+
+    def no_query(*args, **kwargs):
+        raise AssertionError("unexpected query")
+    monkeypatch.setattr(db, "execute", no_query)
+    with pytest.raises(QuotaExceeded):
+        quota.check(1)
+    with pytest.raises(QuotaExceeded):
+        quota.charge(1)
+
+
+def test_quota_sees_calls_charged_by_other_workers(db):
+    clock = FakeClock(86400 * 20000)
+    ours, theirs = DailyQuota(db, limit=2, clock=clock), DailyQuota(db, limit=2, clock=clock)
+    assert ours.charge(1) == 1
+    assert theirs.charge(1) == 2
+    with pytest.raises(QuotaExceeded):
+        ours.charge(1)
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    app_module.db.execute("DELETE FROM ai_usage")
+    app_module.db.execute("INSERT OR IGNORE INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    monkeypatch.setattr(app_module.ai_quota, "cache", {})
+    monkeypatch.setattr(app_module, "rate_limiter", RateLimiter())
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+        session["username"] = "alice"
+    return client
+
+
+def charged(app_module):
+    rows = app_module.db.execute("SELECT calls FROM ai_usage WHERE user_id = 1")
+    return rows[0]["calls"] if rows else 0
+
+
+def test_empty_chat_message_is_not_charged(app_module, client):
+    response = client.post("/send_message", data={"message": "  "})
+    assert response.status_code == 400
+    assert charged(app_module) == 0
+
+
+def test_used_up_quota_turns_chat_away(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module.ai_quota, "limit", 1)
+    app_module.ai_quota.charge(1)
+    response = client.post("/send_message", data={"message": "hi"}, headers={"Accept": "application/json"})
+    assert response.status_code == 429
+    assert charged(app_module) == 1
+
+
+def test_coalesced_plan_request_is_not_charged(app_module, client):
+    key = app_module.plan_request_key("diet", 1)
+    job_id = app_module.db.execute(
+        "INSERT INTO plan_jobs (user_id, kind, status, dedupe_key) VALUES (1, 'diet', 'running', ?)", key
+    )
+    try:
+        response = client.post("/generate_new_plan", headers={"Accept": "application/json"})
+        assert response.status_code == 202
+        assert response.get_json()["job_id"] == job_id
+        assert charged(app_module) == 0
+    finally:
+        app_module.db.execute("UPDATE plan_jobs SET status = 'done' WHERE id = ?", job_id)
+
+
+@pytest.fixture
+def diet_profile(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "diet_plan_profile", lambda user_id: {"bmi": 22.0, "previous_history": ""})
+    monkeypatch.setattr(app_module, "request_plan", lambda kind, prompt, profile: {"week": {}})
+
+
+def test_plan_cache_hit_is_not_charged(app_module, client, diet_profile, monkeypatch):
+    monkeypatch.setattr(app_module.plan_cache, "get", lambda key: {"week": {}})
+
+    def no_model_call(*args):
+        raise AssertionError("unexpected model call")
+    monkeypatch.setattr(app_module, "request_plan", no_model_call)
+    app_module.generate_weekly_diet_plan_ai(1, charge_quota=True)
+    assert charged(app_module) == 0
+
+
+def test_plan_cache_miss_is_charged(app_module, client, diet_profile):
+    app_module.generate_weekly_diet_plan_ai(1, bypass_cache=True, charge_quota=True)
+    assert charged(app_module) == 1
+
+
+def test_plan_job_over_quota_fails_with_a_code(app_module, client, diet_profile, monkeypatch):
+    monkeypatch.setattr(app_module.ai_quota, "limit", 1)
+    app_module.ai_quota.charge(1)
+    with pytest.raises(JobFailed) as e:
+        app_module.generate_weekly_diet_plan_ai(1, bypass_cache=True, charge_quota=True)
+    assert e.value.code == "quota_exceeded"